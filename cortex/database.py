@@ -15,6 +15,7 @@ from hashlib import sha1
 from builtins import input
 
 from . import options
+from . import profiling
 
 default_filestore = options.config.get('basic', 'filestore')
 
@@ -27,7 +28,10 @@ def _memo(fn):
         #h = sha1(str((id(fn), args, kwargs))).hexdigest()
         h = str((id(fn), args, kwargs))
         if h not in self._memocache:
+            profiling.count("db.%s.miss"%fn.__name__)
             self._memocache[h] = fn(self, *args, **kwargs)
+        else:
+            profiling.count("db.%s.hit"%fn.__name__)
         return copy.deepcopy(self._memocache[h])
 
     return memofn
@@ -512,7 +516,11 @@ class Database(object):
         try:
             from . import formats
             fnm = str(os.path.splitext(files[type][hemi])[0])
-            return formats.read(fnm)
+            with profiling.timer("db.get_surf", subject=subject, type=type, hemisphere=hemi) as timer:
+                surf = formats.read(fnm)
+                timer.items = len(surf[0])
+                timer.bytes = sum(os.path.getsize(f) for f in glob.glob(fnm + ".*"))
+            return surf
         except KeyError:
             raise IOError
 
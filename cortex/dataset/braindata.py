@@ -460,7 +460,7 @@ class VertexData(BrainData):
         """
         return super(VertexData, self).copy(data, self.subject)
 
-    def volume(self, xfmname, projection='nearest', **kwargs):
+    def volume(self, xfmname, projection='nearest', method='solve', **kwargs):
         """
         Map this VertexData back to volume space, creating a VolumeData object.
         This uses the `mapper.backwards` function, which is not particularly
@@ -474,6 +474,10 @@ class VertexData(BrainData):
         projection : str, optional
             The type of projection method to use. See the docs for `mapper` for
             possibilities. Default: nearest.
+        method : str, optional
+            'solve' (default) solves the least-squares inverse of the mapper.
+            'operator' applies the mapper's cached sparse approximate inverse,
+            which is much faster when mapping many (or movie) vertex maps.
         **kwargs 
             Other keyword args are passed to the `mapper.backwards` function.
 
@@ -486,7 +490,7 @@ class VertexData(BrainData):
         warnings.warn('Inverse mapping cannot be accurate')
         from cortex import utils
         mapper = utils.get_mapper(self.subject, xfmname, projection)
-        return mapper.backwards(self, **kwargs)
+        return mapper.backwards(self, method=method, **kwargs)
 
     def __repr__(self):
         maskstr = ""
@@ -1,13 +1,15 @@
 import os
+import time
 
 import numpy as np
 
 from .. import dataset
-from .mapper import Mapper, _savecache
+from .. import profiling
+from .mapper import Mapper, logger, _savecache, _surfcoords
+from .multi import MultiMapper
 
 
-def get_mapper(subject, xfmname, type='nearest', recache=False, **kwargs):
-    from ..database import db
+def _get_mapcls(type):
     from . import point, patch, line
 
     mapcls = dict(
@@ -20,20 +22,220 @@ def get_mapper(subject, xfmname, type='nearest', recache=False, **kwargs):
         const_patch_lanczos=patch.ConstPatchLanczos,
         line_nearest=line.LineNN,
         line_trilinear=line.LineTrilin)
-    Map = mapcls[type]
+    return mapcls[type]
+
+def _get_cachefile(subject, xfmname, Map, **kwargs):
+    from ..database import db
     ptype = Map.__name__.lower()
     kwds ='_'.join(['%s%s'%(k,str(v)) for k, v in list(kwargs.items())])
     if len(kwds) > 0:
         ptype += '_'+kwds
 
-    fname = "{xfmname}_{projection}.npz".format(xfmname=xfmname, projection=ptype)
+    fname = "{xfmname}_{projection}".format(xfmname=xfmname, projection=ptype)
+    return os.path.join(db.get_cache(subject), fname)
 
+def _load_cache(subject, xfmname, Map, cachefile):
+    """Loads the mapper cache if it is newer than the transform, migrating legacy
+    npz caches on the way. Returns None if there is no valid cache."""
+    from ..database import db
     xfmfile = db.get_paths(subject)['xfmdir'].format(xfmname=xfmname)
-    cachefile = os.path.join(db.get_cache(subject), fname)
+    npzfile = cachefile + ".npz"
+
+    def fresh(fname):
+        return xfmname == "identity" or os.stat(fname).st_mtime > os.stat(xfmfile).st_mtime
 
     try:
-        if not recache and (xfmname == "identity" or os.stat(cachefile).st_mtime > os.stat(xfmfile).st_mtime):
-            return Map.from_cache(cachefile, subject, xfmname)
-        raise Exception
+        if not os.path.exists(cachefile) and fresh(npzfile):
+            # Migrate the legacy npz cache to the memory-mapped format
+            mapper = Map.from_cache(npzfile, subject, xfmname)
+            _savecache(cachefile, mapper.masks[0], mapper.masks[1], mapper.shape)
+            os.unlink(npzfile)
+        if fresh(os.path.join(cachefile, "shape.npy")):
+            mapper = Map.from_cache(cachefile, subject, xfmname)
+            profiling.count("mapper.cache.hit", subject=subject, xfmname=xfmname, type=Map.__name__)
+            return mapper
     except Exception:
-        return Map._cache(cachefile, subject, xfmname, **kwargs)
+        pass
+    profiling.count("mapper.cache.miss", subject=subject, xfmname=xfmname, type=Map.__name__)
+    return None
+
+def get_mapper(subject, xfmname, type='nearest', recache=False, **kwargs):
+    Map = _get_mapcls(type)
+    cachefile = _get_cachefile(subject, xfmname, Map, **kwargs)
+
+    mapper = None
+    if not recache:
+        mapper = _load_cache(subject, xfmname, Map, cachefile)
+    if mapper is None:
+        mapper = Map._cache(cachefile, subject, xfmname, **kwargs)
+    return mapper
+
+def _build_mask(Map, args, kwargs, seed):
+    if seed is not None:
+        np.random.seed(seed)
+    tic = time.time()
+    mask = Map._getmask(*args, **kwargs)
+    return mask, time.time() - tic
+
+def build_mappers(subject, xfmname, types=('nearest', 'trilinear'), n_jobs=None,
+                  recache=False, seed=0, **kwargs):
+    """Builds and caches the mappers of several projection types at once.
+
+    The surfaces are loaded and transformed into the volume space once, and the
+    masks for every (type, hemisphere) pair are then built in parallel over a
+    process pool. Each cache is written atomically, so concurrent jobs never
+    read a partially written mapper.
+
+    Parameters
+    ----------
+    subject : str
+        Name of the subject
+    xfmname : str
+        Name of the transform
+    types : list of str, optional
+        Projection types to build, as accepted by `get_mapper`.
+    n_jobs : int, optional
+        Number of worker processes. Defaults to the number of CPUs; with 1 the
+        masks are built in this process.
+    recache : bool, optional
+        Rebuild the mappers even if a valid cache exists.
+    seed : int or None, optional
+        Seed for the random sampling of patch mappers, so that the result does
+        not depend on `n_jobs`. None leaves the random state alone.
+    **kwargs
+        Other keyword arguments are passed to every mapper, as in `get_mapper`.
+
+    Returns
+    -------
+    mappers : dict
+        Mapper for each projection type.
+    timings : dict
+        Time in seconds spent building the masks of each type, summed over both
+        hemispheres. Types that were loaded from the cache are not included.
+    """
+    from ..database import db
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    mappers, jobs = dict(), []
+    for type in types:
+        Map = _get_mapcls(type)
+        cachefile = _get_cachefile(subject, xfmname, Map, **kwargs)
+        if not recache:
+            mappers[type] = _load_cache(subject, xfmname, Map, cachefile)
+        if mappers.get(type) is None:
+            jobs.append((type, Map, cachefile))
+
+    if len(jobs) == 0:
+        return mappers, dict()
+
+    xfm = db.get_xfm(subject, xfmname, xfmtype='coord')
+    coords = _surfcoords(subject, xfm)
+    tasks = []
+    for type, Map, cachefile in jobs:
+        for hemi, args in enumerate(Map._hemiargs(subject, xfm, coords)):
+            hseed = None if seed is None else seed + hemi
+            tasks.append((Map, args, kwargs, hseed))
+
+    if n_jobs is None:
+        n_jobs = multiprocessing.cpu_count()
+    if n_jobs == 1:
+        results = [_build_mask(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            results = list(pool.map(_build_mask, *zip(*tasks)))
+
+    timings = dict()
+    for i, (type, Map, cachefile) in enumerate(jobs):
+        (left, ltime), (right, rtime) = results[2*i:2*i+2]
+        _savecache(cachefile, left, right, xfm.shape)
+        mappers[type] = Map(left, right, xfm.shape, subject, xfmname)
+        mappers[type].cachefile = cachefile
+        timings[type] = ltime + rtime
+        logger.info('Built %s mapper in %0.2f seconds', type, timings[type])
+
+    return mappers, timings
+
+class _NiftiFrames(object):
+    """Frames of a NIfTI image, read lazily from its array proxy in pycortex
+    (t, z, y, x) order"""
+    def __init__(self, dataobj):
+        self.dataobj = dataobj
+        self.shape = (dataobj.shape[3] if len(dataobj.shape) > 3 else 1,) + dataobj.shape[:3][::-1]
+
+    def __getitem__(self, idx):
+        if len(self.dataobj.shape) == 3:
+            return np.asarray(self.dataobj)[..., np.newaxis].T[idx]
+        return np.asarray(self.dataobj[..., idx]).T
+
+def project_file(subject, xfmname, path, out_path, type='nearest', chunk=64,
+                 in_name=None, mask=None, out_name='data', **kwargs):
+    """Projects a volumetric time series stored on disk onto the surface,
+    streaming it through the cached mapper.
+
+    Frames are read lazily, `chunk` at a time, from a NIfTI file through its
+    array proxy or from an HDF5 dataset, and appended to an HDF5 vertex dataset.
+    Peak memory is bounded by the chunk size rather than the length of the run.
+
+    Parameters
+    ----------
+    subject : str
+        Name of the subject
+    xfmname : str
+        Name of the transform
+    path : str
+        NIfTI file, or HDF5 file when `in_name` is given.
+    out_path : str
+        HDF5 file receiving the vertex data.
+    type : str, optional
+        Projection type, as accepted by `get_mapper`. Default: nearest.
+    chunk : int, optional
+        Number of frames read and projected at once. Default: 64.
+    in_name : str, optional
+        Name of the input dataset in the HDF5 file `path`, with frames along the
+        first axis, either as (t, z, y, x) volumes or as masked (t, nvox) data.
+    mask : ndarray, optional
+        Boolean volume selecting the voxels of masked HDF5 input.
+    out_name : str, optional
+        Name of the output dataset. If it already exists, the new frames are
+        appended to it.
+    **kwargs
+        Other keyword arguments are passed to `get_mapper`.
+
+    Returns
+    -------
+    shape : tuple
+        Shape of the output dataset, (t, nverts).
+    """
+    import h5py
+    mapper = get_mapper(subject, xfmname, type=type, **kwargs)
+    nverts = mapper.stacked().shape[0]
+
+    infile = None
+    if in_name is not None:
+        infile = h5py.File(path, "r")
+        frames = infile[in_name]
+    else:
+        import nibabel
+        frames = _NiftiFrames(nibabel.load(path).dataobj)
+
+    try:
+        with h5py.File(out_path, "a") as h5:
+            if out_name in h5:
+                out = h5[out_name]
+                offset = out.shape[0]
+                out.resize(offset + frames.shape[0], axis=0)
+            else:
+                offset = 0
+                rows = max(min(chunk, frames.shape[0]), 1)
+                out = h5.create_dataset(out_name, (frames.shape[0], nverts), dtype=np.float32,
+                                        maxshape=(None, nverts), chunks=(rows, nverts))
+            out.attrs['subject'] = subject
+
+            for start in range(0, frames.shape[0], chunk):
+                mapped = mapper.map_timeseries(frames[start:start+chunk], chunk_frames=chunk, mask=mask)
+                out[offset+start:offset+start+len(mapped)] = mapped
+            return out.shape
+    finally:
+        if infile is not None:
+            infile.close()
@@ -1,33 +1,33 @@
 import numpy as np
 from scipy import sparse
 
-from . import Mapper, _savecache
+from . import Mapper
 from . import samplers
 
 class LineMapper(Mapper):
     @classmethod
-    def _cache(cls, filename, subject, xfmname, **kwargs):
-        from .. import db
-        masks = []
-        xfm = db.get_xfm(subject, xfmname, xfmtype='coord')
-        pia = db.get_surf(subject, "pia", merge=False, nudge=False)
-        wm = db.get_surf(subject, "wm", merge=False, nudge=False)
-        
+    def _hemiargs(cls, subject, xfm, coords):
+        pia, wm = coords("pia"), coords("wm")
         #iterate over hemispheres
-        for (wpts, polys), (ppts, _) in zip(pia, wm):
-            masks.append(cls._getmask(xfm(ppts), xfm(wpts), polys, xfm.shape, **kwargs))
-            
-        _savecache(filename, masks[0], masks[1], xfm.shape)
-        return cls(masks[0], masks[1], xfm.shape, subject, xfmname)
+        return [(ppts, wpts, polys, xfm.shape) for (wpts, polys), (ppts, _) in zip(pia, wm)]
 
     @classmethod
-    def _getmask(cls, pia, wm, polys, shape, npts=64, mp=True, **kwargs):
-        valid = np.unique(polys)
-        #vidx = np.nonzero(valid)[0]
-        mapper = sparse.csr_matrix((len(pia), np.prod(shape)))
-        for t in np.linspace(0, 1, npts+2)[1:-1]:
-            i, j, data = cls.sampler(pia*t + wm*(1-t), shape)
-            mapper = mapper + sparse.csr_matrix((data / npts, (i, j)), shape=mapper.shape)
+    def _getmask(cls, pia, wm, polys, shape, npts=64, mp=True, chunk=None, **kwargs):
+        """Samples `npts` points along each line from white matter to pia. All the
+        (i, j, data) triples are gathered and summed in a single sparse conversion;
+        `chunk` bounds the number of depth samples held in memory at once."""
+        csrshape = len(pia), np.prod(shape)
+        depths = np.linspace(0, 1, npts+2)[1:-1]
+        if chunk is None:
+            chunk = npts
+
+        mapper = sparse.csr_matrix(csrshape)
+        for start in range(0, npts, chunk):
+            samples = [cls.sampler(pia*t + wm*(1-t), shape) for t in depths[start:start+chunk]]
+            i = np.concatenate([sample[0] for sample in samples])
+            j = np.concatenate([sample[1] for sample in samples])
+            data = np.concatenate([sample[2] for sample in samples]) / npts
+            mapper = mapper + sparse.coo_matrix((data, (i, j)), shape=csrshape).tocsr()
         return mapper
 
 class LineNN(LineMapper):
@@ -1,13 +1,28 @@
+import os
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+from collections import OrderedDict
+
 import numpy as np
 from scipy import sparse
+import scipy.sparse.linalg
 
 from .. import dataset
+from .. import profiling
 
 import warnings
 warnings.simplefilter('ignore', sparse.SparseEfficiencyWarning)
 
+logger = logging.getLogger("cortex.mapper")
+
 class Mapper(object):
     '''Maps data from epi volume onto surface using various projections'''
+    #number of masked stacked matrices kept by `stacked`
+    stacked_cache_size = 4
+
     def __init__(self, left, right, shape, subject, xfmname):
         self.idxmap = None
         self.masks = [left, right]
@@ -15,15 +30,30 @@ class Mapper(object):
         self.shape = shape
         self.subject = subject
         self.xfmname = xfmname
+        self.cachefile = None
+        self._stacked = None
+        self._masked = OrderedDict()
 
     @classmethod
     def from_cache(cls, cachefile, subject, xfmname):
-        npz = np.load(cachefile)
+        """Loads a mapper from its cache. New style caches are directories holding
+        one raw .npy file per array, which are memory-mapped read-only so that the
+        CSR matrices are built without copying and shared through the page cache
+        by every process using the same mapper. Legacy npz caches are loaded into
+        memory."""
+        legacy = cachefile.endswith('.npz')
+        if not legacy:
+            npz = _loadcache(cachefile)
+        else:
+            npz = np.load(cachefile)
         left = (npz['left_data'], npz['left_indices'], npz['left_indptr'])
         right = (npz['right_data'], npz['right_indices'], npz['right_indptr'])
-        lsparse = sparse.csr_matrix(left, shape=npz['left_shape'])
-        rsparse = sparse.csr_matrix(right, shape=npz['right_shape'])
-        return cls(lsparse, rsparse, npz['shape'], subject, xfmname)
+        lsparse = sparse.csr_matrix(left, shape=tuple(npz['left_shape']), copy=False)
+        rsparse = sparse.csr_matrix(right, shape=tuple(npz['right_shape']), copy=False)
+        mapper = cls(lsparse, rsparse, tuple(npz['shape']), subject, xfmname)
+        if not legacy:
+            mapper.cachefile = cachefile
+        return mapper
 
     @property
     def mask(self):
@@ -57,87 +87,372 @@ class Mapper(object):
                     right = right[..., self.idxmap[1]]
             return left, right
 
-        volume = np.ascontiguousarray(data.volume)
-        volume.shape = len(volume), -1
-        volume = volume.T
+        if data.movie:
+            return dataset.Vertex(self.map_timeseries(data), data.subject)
+
+        if data.linear:
+            mapped = self.stacked(data.mask).dot(data.data)
+        else:
+            mapped = self.stacked().dot(np.ravel(data.data))
+
+        return dataset.Vertex(mapped, data.subject)
+
+    def stacked(self, mask=None):
+        """Both hemisphere masks stacked into a single (nverts, nvox) CSR matrix.
+
+        The stacked matrix is built once and cached on the mapper. If `mask` is
+        given, only the columns of the voxels inside the mask are kept, so that
+        masked (linear) data can be projected without unmasking it first. The
+        last `stacked_cache_size` masked matrices are kept.
+
+        Parameters
+        ----------
+        mask : ndarray, optional
+            Boolean volume of shape `self.shape` selecting the voxels present in
+            the data.
+
+        Returns
+        -------
+        stacked : scipy.sparse.csr_matrix
+            Sparse projection matrix from voxels onto vertices.
+        """
+        if self._stacked is None:
+            stacked = sparse.vstack(self.masks).tocsr()
+            if self.idxmap is not None:
+                llen = self.masks[0].shape[0]
+                stacked = stacked[np.hstack([self.idxmap[0], self.idxmap[1] + llen])]
+            self._stacked = stacked
+
+        if mask is None:
+            return self._stacked
+
+        mask = np.asarray(mask, dtype=bool)
+        key = hashlib.sha1(np.packbits(mask.ravel()).tobytes()).hexdigest()
+        masked = self._masked.pop(key, None)
+        if masked is None:
+            masked = self._stacked[:, np.nonzero(mask.ravel())[0]].tocsr()
+        self._masked[key] = masked
+        while len(self._masked) > self.stacked_cache_size:
+            self._masked.popitem(last=False)
+        return masked
+
+    def map_timeseries(self, volume_iter, chunk_frames=64, out=None, mask=None):
+        """Projects a volumetric time series onto the surface, chunk by chunk.
+
+        Frames are projected `chunk_frames` at a time through the stacked mapper
+        and written directly into `out`, so the full run never has to be copied,
+        unmasked or transposed in memory.
+
+        Parameters
+        ----------
+        volume_iter : Volume, array_like or iterable
+            Time series to project. Either a movie Volume, an array-like object
+            (ndarray, memmap, h5py dataset) with frames along the first axis, or
+            an iterable yielding single frames or blocks of frames. Frames can be
+            full volumes of shape `self.shape` or masked vectors.
+        chunk_frames : int, optional
+            Number of frames projected per sparse product. Default 64.
+        out : array_like, optional
+            Preallocated (T, nverts) output, e.g. a numpy memmap or an h5py
+            dataset. If None, a new array is allocated.
+        mask : ndarray, optional
+            Boolean volume selecting the voxels of masked frames. Taken from the
+            Volume if `volume_iter` is masked Volume data.
+
+        Returns
+        -------
+        out : array_like
+            Projected time series with shape (T, nverts).
+        """
+        if isinstance(volume_iter, dataset.Volume):
+            if volume_iter.linear:
+                mask = volume_iter.mask
+            volume_iter = volume_iter.data
+            if volume_iter.ndim in (1, 3):
+                volume_iter = volume_iter[np.newaxis]
 
-        mapped = []
-        for mask in self.masks:
-            mapped.append(np.array(mask * volume).T)
+        mapper = self.stacked(mask)
+        nvox = mapper.shape[1]
+        if out is None and hasattr(volume_iter, 'shape'):
+            out = np.empty((volume_iter.shape[0], mapper.shape[0]))
 
-        if self.idxmap is not None:
-            mapped[0] = mapped[0][:, self.idxmap[0]]
-            mapped[1] = mapped[1][:, self.idxmap[1]]
+        chunks = []
+        start = 0
+        for chunk in _iter_frames(volume_iter, chunk_frames, nvox, int(np.prod(self.shape))):
+            mapped = mapper.dot(chunk.T).T
+            if out is None:
+                chunks.append(mapped)
+            else:
+                out[start:start + len(mapped)] = mapped
+            start += len(mapped)
 
-        return dataset.Vertex(np.hstack(mapped).squeeze(), data.subject)
+        if out is None:
+            return np.vstack(chunks) if len(chunks) > 0 else np.empty((0, mapper.shape[0]))
+        return out
 
-    def backwards(self, vertexdata):
+    def backwards(self, vertexdata, method='solve'):
         '''Projects vertex data back into volume space.
 
+        The least-squares system is only solved over the voxels that the mapper
+        touches; its factorization is computed once and kept on the mapper, so
+        repeated calls only pay for the triangular solves.
+
         Parameters
         ----------
         vertexdata : Vertex object or array
             The data that will be projected back into voxel space.
             If Vertex object is provided, a Volume object is returned
-            If an array is provided, an array is returned
+            If an array is provided, an array is returned. A 2D array of shape
+            (nverts, K) is solved in one block, giving K volumes.
+        method : {'solve', 'operator'}
+            'solve' solves the least-squares inverse of the mapper. 'operator'
+            applies the precomputed approximate inverse from `backward_operator`,
+            a single sparse product.
         '''
         Vert2Vol = isinstance(vertexdata, dataset.Vertex)
         if Vert2Vol:
-            to_map = vertexdata.data
+            to_map = vertexdata.data.T
         else:
-            to_map = vertexdata
-        # stack the two mappers together
-        bothmappers = sparse.vstack(self.masks)
-        # dot the vertex data with the stacked mappers
-        partial_vertex = bothmappers.T.dot(to_map)
-        # solve the inverse mapping problem
-        voxeldata = self._get_backmapper().solve(partial_vertex).reshape(self.shape)
+            to_map = np.asarray(vertexdata)
+
+        if method == 'operator':
+            voxeldata = self.backward_operator().dot(to_map)
+        elif method == 'solve':
+            solver, voxels = self._get_backmapper()
+            # dot the vertex data with the stacked mappers
+            partial_vertex = self.stacked().T.dot(to_map)
+            # solve the inverse mapping problem for the voxels touched by the mapper
+            voxeldata = np.zeros(partial_vertex.shape)
+            voxeldata[voxels] = solver(partial_vertex[voxels])
+        else:
+            raise ValueError('Unknown backwards method: %s'%method)
+        if voxeldata.ndim > 1:
+            voxeldata = voxeldata.T.reshape((-1,)+tuple(self.shape))
+        else:
+            voxeldata = voxeldata.reshape(self.shape)
         if Vert2Vol:
             # construct a volume object with the new data
             return dataset.Volume(voxeldata, self.subject, self.xfmname)
         else:
             return voxeldata
 
+    def backward_operator(self):
+        """Sparse (nvox, nverts) approximate inverse of the mapper.
+
+        This is the transpose of the mapper with each row normalized to sum to 1,
+        so that every voxel gets the weighted average of the vertices sampling it.
+        It is cached alongside the mapper cache, and maps many vertex maps into
+        the volume with a single sparse product.
+
+        Returns
+        -------
+        operator : scipy.sparse.csr_matrix
+            Vertex to voxel projection matrix.
+        """
+        if not hasattr(self, '_backward_operator'):
+            opfile = None
+            if self.cachefile is not None:
+                opfile = os.path.join(self.cachefile, 'backward_operator.npz')
+
+            if opfile is not None and os.path.exists(opfile):
+                operator = sparse.load_npz(opfile)
+            else:
+                transpose = self.stacked().T.tocsr()
+                norm = np.array(transpose.sum(1)).ravel()
+                norm[norm == 0] = 1
+                operator = sparse.diags(1. / norm).dot(transpose).tocsr()
+                if opfile is not None:
+                    # write and rename so that concurrent readers never see a partial file
+                    fd, tmpfile = tempfile.mkstemp(suffix='.npz', dir=self.cachefile)
+                    os.close(fd)
+                    sparse.save_npz(tmpfile, operator, compressed=False)
+                    _chmod_umask(tmpfile)
+                    os.rename(tmpfile, opfile)
+            self._backward_operator = operator
+
+        return self._backward_operator
+
     def _get_backmapper(self):
+        """Returns the factorized normal equations of the mapper, restricted to the
+        voxels it touches, and the indices of those voxels. Uses CHOLMOD when
+        scikit-sparse is installed, sparse LU otherwise."""
         if not hasattr(self, '_backmapper'):
-            # stack the two mappers together to get one voxel -> vertex mapper
-            bothmappers = sparse.vstack(self.masks)
+            bothmappers = self.stacked()
+            voxels = np.unique(bothmappers.indices)
+            bothmappers = bothmappers[:, voxels]
             # take inner product to get symmetric matrix
             symmappers = bothmappers.T.dot(bothmappers)
             # add (very) small diagonal to make sure it's full rank
-            symmappers_reg = symmappers + 1e-9 * sparse.eye(symmappers.shape[0])
-            # factorize it using splu so that inversion is fast
-            self._backmapper = sparse.linalg.splu(symmappers_reg)
+            symmappers_reg = (symmappers + 1e-9 * sparse.eye(symmappers.shape[0])).tocsc()
+            try:
+                from sksparse.cholmod import cholesky
+                solver = cholesky(symmappers_reg)
+            except ImportError:
+                # factorize it using splu so that inversion is fast
+                solver = sparse.linalg.splu(symmappers_reg).solve
+            self._backmapper = solver, voxels
 
         return self._backmapper
 
     @classmethod
-    def _cache(cls, filename, subject, xfmname, **kwargs):
-        print('Caching mapper...')
+    def _cache(cls, filename, subject, xfmname, xfm=None, coords=None, **kwargs):
+        """Builds the mapper and saves it to `filename`. The transform and the
+        transformed surfaces (see `_surfcoords`) are loaded unless given."""
+        logger.info('Caching %s mapper for %s/%s...', cls.__name__, subject, xfmname)
         from ..database import db
-        masks = []
-        xfm = db.get_xfm(subject, xfmname, xfmtype='coord')
-        fid = db.get_surf(subject, 'fiducial', merge=False, nudge=False)
+        with profiling.timer("mapper.cache", subject=subject, xfmname=xfmname, type=cls.__name__) as timer:
+            if xfm is None:
+                xfm = db.get_xfm(subject, xfmname, xfmtype='coord')
+            if coords is None:
+                coords = _surfcoords(subject, xfm)
+            masks = [cls._getmask(*args, **kwargs) for args in cls._hemiargs(subject, xfm, coords)]
+            timer.items = sum(mask.shape[0] for mask in masks)
+
+            _savecache(filename, masks[0], masks[1], xfm.shape)
+        mapper = cls(masks[0], masks[1], xfm.shape, subject, xfmname)
+        mapper.cachefile = filename
+        return mapper
 
+    @classmethod
+    def _hemiargs(cls, subject, xfm, coords):
+        """Positional arguments of `_getmask` for each hemisphere. `coords` returns
+        the transformed points and polygons of both hemispheres for a surface type,
+        see `_surfcoords`."""
+        from ..database import db
+        fid = coords('fiducial')
         try:
             flat = db.get_surf(subject, 'flat', merge=False, nudge=False)
         except IOError:
             flat = fid
 
-        for (pts, _), (_, polys) in zip(fid, flat):
-            masks.append(cls._getmask(xfm(pts), polys, xfm.shape, **kwargs))
+        return [(pts, polys, xfm.shape) for (pts, _), (_, polys) in zip(fid, flat)]
+
+def _surfcoords(subject, xfm):
+    """Returns a function giving the [(pts, polys), (pts, polys)] hemisphere pairs
+    of a surface type, with the points transformed by `xfm`. Each surface type is
+    only loaded and transformed once."""
+    return _multisurfcoords(subject, [xfm])[0]
 
-        _savecache(filename, masks[0], masks[1], xfm.shape)
-        return cls(masks[0], masks[1], xfm.shape, subject, xfmname)
+def _multisurfcoords(subject, xfms):
+    """Like `_surfcoords`, for a list of transforms. Returns one function per
+    transform; each surface type is loaded once and transformed by all of the
+    transforms in a single batched product."""
+    from ..database import db
+    matrices = np.array([xfm.xfm for xfm in xfms])[:, :3]
+    surfs = dict()
+    def transform(surftype):
+        if surftype not in surfs:
+            hemis = db.get_surf(subject, surftype, merge=False, nudge=False)
+            surfs[surftype] = []
+            for pts, polys in hemis:
+                hpts = np.hstack([pts, np.ones((len(pts), 1))]).T
+                surfs[surftype].append((np.dot(matrices, hpts).transpose(0, 2, 1), polys))
+        return surfs[surftype]
+
+    def make_coords(k):
+        def coords(surftype):
+            return [(pts[k], polys) for pts, polys in transform(surftype)]
+        return coords
+    return [make_coords(k) for k in range(len(xfms))]
+
+def _check_frames(shape, nvox, nfull):
+    """Raises a ValueError unless `shape` is that of a frame or of a block of
+    frames of `nvox` voxels. `nfull` is the number of voxels of a full volume."""
+    size, framesize = int(np.prod(shape)), int(np.prod(shape[1:]))
+    if size == nvox or (len(shape) > 1 and framesize == nvox):
+        return
+    if nvox != nfull and nfull in (size, framesize):
+        raise ValueError('Frames of shape %r are full volumes of %d voxels, but the '
+                         'mask selects %d voxels: pass masked frames, or no mask' %
+                         (tuple(shape), nfull, nvox))
+    raise ValueError('Frames of shape %r match neither the %d masked voxels nor the '
+                     '%d voxels of the full volume' % (tuple(shape), nvox, nfull))
+
+def _iter_frames(frames, chunk_frames, nvox, nfull=None):
+    """Yields (n, nvox) blocks of at most about `chunk_frames` frames from an
+    array-like object or an iterable of frames. Each frame must have `nvox`
+    voxels; `nfull`, the size of a full volume, only refines the error."""
+    nfull = nvox if nfull is None else nfull
+    if hasattr(frames, 'shape') and hasattr(frames, '__getitem__'):
+        _check_frames(frames.shape, nvox, nfull)
+        for start in range(0, frames.shape[0], chunk_frames):
+            yield np.asarray(frames[start:start + chunk_frames]).reshape(-1, nvox)
+        return
+
+    block, nframes = [], 0
+    for frame in frames:
+        frame = np.asarray(frame)
+        _check_frames(frame.shape, nvox, nfull)
+        block.append(frame.reshape(-1, nvox))
+        nframes += len(block[-1])
+        if nframes >= chunk_frames:
+            yield np.vstack(block)
+            block, nframes = [], 0
+    if len(block) > 0:
+        yield np.vstack(block)
+
+_cachekeys = ['left_data', 'left_indices', 'left_indptr', 'left_shape',
+              'right_data', 'right_indices', 'right_indptr', 'right_shape',
+              'shape']
+
+def _chmod_umask(path, mode=0o666):
+    """Gives `path` the permissions open() or mkdir() would have given it, rather
+    than the private ones of tempfile, so that caches in a shared filestore stay
+    readable by other users."""
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(path, mode & ~umask)
+
+def _loadcache(dirname, attempts=3):
+    """Memory-maps the arrays of the cache directory `dirname`.
+
+    `_savecache` replaces an existing cache with two renames, so a reader may find
+    the directory missing, or open files of both versions. The directory is
+    checked to be the same before and after loading, and the load is retried
+    otherwise."""
+    for attempt in range(attempts):
+        try:
+            inode = os.stat(dirname).st_ino
+            arrays = dict((key, np.load(os.path.join(dirname, key+'.npy'), mmap_mode='r'))
+                          for key in _cachekeys)
+            if os.stat(dirname).st_ino == inode:
+                return arrays
+        except (IOError, OSError):
+            if attempt == attempts - 1:
+                raise
+        time.sleep(.05)
+    raise IOError('Mapper cache %s changed while loading'%dirname)
 
 def _savecache(filename, left, right, shape):
-    np.savez(filename,
-             left_data=left.data,
-             left_indices=left.indices,
-             left_indptr=left.indptr,
-             left_shape=left.shape,
-             right_data=right.data,
-             right_indices=right.indices,
-             right_indptr=right.indptr,
-             right_shape=right.shape,
-             shape=shape)
+    """Saves the mapper into the directory `filename`, one uncompressed .npy file
+    per array so that they can be memory-mapped by `Mapper.from_cache`.
+
+    The files are written into a temporary directory which is then renamed into
+    place, so that concurrent readers never see a partially written cache. An
+    existing cache is first moved aside, so the cache is briefly missing;
+    `_loadcache` retries in that case."""
+    arrays = dict(
+        left_data=left.data,
+        left_indices=left.indices,
+        left_indptr=left.indptr,
+        left_shape=left.shape,
+        right_data=right.data,
+        right_indices=right.indices,
+        right_indptr=right.indptr,
+        right_shape=right.shape,
+        shape=shape)
+    path, name = os.path.split(os.path.abspath(filename))
+    tmpdir = tempfile.mkdtemp(prefix='.%s.'%name, dir=path)
+    for key in _cachekeys:
+        np.save(os.path.join(tmpdir, key+'.npy'), np.asarray(arrays[key]))
+    _chmod_umask(tmpdir, 0o777)
+
+    # Move an existing cache out of the way first: processes that have it mapped
+    # keep reading the old files until they are done with them
+    olddir = None
+    if os.path.exists(filename):
+        olddir = tempfile.mkdtemp(prefix='.%s.'%name, dir=path)
+        os.rename(filename, os.path.join(olddir, name))
+    os.rename(tmpdir, filename)
+    if olddir is not None:
+        shutil.rmtree(olddir, ignore_errors=True)
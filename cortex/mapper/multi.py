@@ -0,0 +1,73 @@
+from .. import dataset
+from .mapper import _multisurfcoords
+
+class MultiMapper(object):
+    '''Maps the data of many sessions of one subject, each with its own transform.
+
+    The surfaces are loaded once and transformed into every session's volume
+    space with a single batched product, instead of repeating the setup for each
+    transform. Mappers that are already cached are loaded from the cache, the
+    others are built and cached as `get_mapper` would.
+
+    Parameters
+    ----------
+    subject : str
+        Name of the subject
+    xfmnames : list of str
+        Transform of each session
+    type : str, optional
+        Projection type, as accepted by `get_mapper`. Default: nearest.
+    recache : bool, optional
+        Rebuild the mappers even if a valid cache exists.
+    **kwargs
+        Other keyword arguments are passed to every mapper, as in `get_mapper`.
+    '''
+    def __init__(self, subject, xfmnames, type='nearest', recache=False, **kwargs):
+        from ..database import db
+        from . import _get_mapcls, _get_cachefile, _load_cache
+        Map = _get_mapcls(type)
+        self.subject = subject
+        self.xfmnames = list(xfmnames)
+
+        mappers, missing = dict(), []
+        for xfmname in self.xfmnames:
+            cachefile = _get_cachefile(subject, xfmname, Map, **kwargs)
+            if not recache:
+                mappers[xfmname] = _load_cache(subject, xfmname, Map, cachefile)
+            if mappers.get(xfmname) is None:
+                missing.append((xfmname, cachefile))
+
+        if len(missing) > 0:
+            xfms = [db.get_xfm(subject, xfmname, xfmtype='coord') for xfmname, _ in missing]
+            allcoords = _multisurfcoords(subject, xfms)
+            for (xfmname, cachefile), xfm, coords in zip(missing, xfms, allcoords):
+                mappers[xfmname] = Map._cache(cachefile, subject, xfmname, xfm=xfm,
+                                              coords=coords, **kwargs)
+
+        self.mappers = [mappers[xfmname] for xfmname in self.xfmnames]
+
+    def __repr__(self):
+        return '<MultiMapper for %d sessions of %s>'%(len(self.mappers), self.subject)
+
+    def __call__(self, volumes):
+        '''Maps one volume (or movie) per session onto the surface.
+
+        Parameters
+        ----------
+        volumes : list
+            Volume objects or arrays, in the same order as `xfmnames`.
+
+        Returns
+        -------
+        vertices : list of Vertex
+            Mapped data of each session.
+        '''
+        if len(volumes) != len(self.mappers):
+            raise ValueError('Expected %d volumes, got %d'%(len(self.mappers), len(volumes)))
+
+        mapped = []
+        for xfmname, mapper, volume in zip(self.xfmnames, self.mappers, volumes):
+            if not isinstance(volume, dataset.Volume):
+                volume = dataset.Volume(volume, self.subject, xfmname)
+            mapped.append(mapper(volume))
+        return mapped
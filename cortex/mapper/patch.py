@@ -1,5 +1,4 @@
 import numpy as np
-from scipy import sparse
 
 from . import Mapper
 from . import samplers
@@ -7,10 +6,10 @@ from .. import polyutils
 
 class PatchMapper(Mapper):
     @classmethod
-    def _getmask(cls, pts, polys, shape, npts=64, mp=True, **kwargs):
+    def _getmask(cls, pts, polys, shape, npts=64, mp=True, executor=None, **kwargs):
         rand = np.random.rand(2, npts)
 
-        def func(ipts):
+        def func(ipts, rand):
             idx, pts = ipts
             if pts is not None:
                 A = np.outer(1-np.sqrt(rand[0]), pts[:,0].ravel())
@@ -20,34 +19,39 @@ class PatchMapper(Mapper):
                 areas = polyutils.face_area(pts)
                 areas /= areas.sum()
 
-                allj, alldata = [], []
-                for tri, area in zip(randpts.swapaxes(0,1), areas):
-                    i, j, data = cls.sampler(tri, shape, renorm=False, mp=False, **kwargs)
-                    alldata.append(data / data.sum() * area)
-                    allj.append(j)
-
-                #print idx
-                return samplers.collapse(np.hstack(allj), np.hstack(alldata))
+                # Sample all the triangles in one call, then weight each triangle's
+                # samples by its share of the patch area
+                tris = randpts.swapaxes(0,1).reshape(-1, pts.shape[2])
+                i, j, data = cls.sampler(tris, shape, renorm=False, mp=False, **kwargs)
+                tri = i // randpts.shape[0]
+                norm = np.bincount(tri, data, minlength=len(areas))
+                return samplers.collapse(j, data / norm[tri] * areas[tri])
             return None, None
 
         surf = polyutils.Surface(pts, polys)
-        patches = surf.patches(n=cls.patchsize)
+        if cls.patchsize == 1:
+            # The patch of a vertex is its ring of faces, which the workers slice
+            # out of the shared points and polygons instead of receiving it pickled
+            faces = surf.connected
+            shared = dict(rand=rand, pts=surf.pts, polys=surf.polys,
+                          indptr=faces.indptr, indices=faces.indices)
+            def patchfunc(idx, rand, pts, polys, indptr, indices):
+                ring = indices[indptr[idx]:indptr[idx+1]]
+                return func((idx, pts[polys[ring]] if len(ring) > 0 else None), rand)
+            items = range(len(pts))
+        else:
+            shared = dict(rand=rand)
+            patchfunc = func
+            items = enumerate(surf.patches(n=cls.patchsize))
+
         if mp:
             from .. import mp
-            samples = mp.map(func, enumerate(patches))
+            samples = mp.map(patchfunc, items, shared=shared, executor=executor)
         else:
-            #samples = map(func, enumerate(patches))
-            samples = [func(x) for x in enumerate(patches)]
-
-        ij, alldata = [], []
-        for i, (j, data) in enumerate(samples):
-            if data is not None:
-                ij.append(np.vstack(np.broadcast_arrays(i, j)).T)
-                alldata.append(data)
+            samples = [patchfunc(x, **shared) for x in items]
 
-        data, ij = np.hstack(alldata), np.vstack(ij).T
         csrshape = len(pts), np.prod(shape)
-        return sparse.csr_matrix((data, ij), shape=csrshape)
+        return samplers.sparse_rows(samples, csrshape)
 
 class ConstPatch(PatchMapper):
     patchsize = 1
@@ -1,9 +1,36 @@
 import numpy as np
+from scipy import sparse
 
 def collapse(j, data):
-    """Collapses samples into a single row"""
-    uniques = np.unique(j)
-    return uniques, np.array([data[j == u].sum() for u in uniques])
+    """Collapses samples into a single row, summing the data of repeated indices"""
+    uniques, inverse = np.unique(j, return_inverse=True)
+    return uniques, np.bincount(inverse.ravel(), weights=data, minlength=len(uniques))
+
+def sparse_rows(samples, shape):
+    """Builds a CSR matrix from one (j, data) sample per row, in order. Rows with
+    a None sample are left empty and repeated indices within a row are summed.
+
+    Parameters
+    ----------
+    samples : iterable
+        (j, data) column indices and values for each row, or None.
+    shape : tuple
+        Shape of the output matrix, (nrows, ncols).
+    """
+    indptr = np.zeros((shape[0]+1,), dtype=np.int64)
+    allj, alldata = [], []
+    for i, sample in enumerate(samples):
+        if sample is not None and sample[0] is not None:
+            allj.append(np.asarray(sample[0]))
+            alldata.append(np.asarray(sample[1], dtype=float))
+            indptr[i+1] = len(allj[-1])
+
+    if len(allj) == 0:
+        return sparse.csr_matrix(shape)
+
+    mapper = sparse.csr_matrix((np.hstack(alldata), np.hstack(allj), np.cumsum(indptr)), shape=shape)
+    mapper.sum_duplicates()
+    return mapper
 
 def nearest(coords, shape, **kwargs):
     valid = ~(np.isnan(coords).all(1))
@@ -49,51 +76,68 @@ def trilinear(coords, shape, **kwargs):
     data = np.vstack([v000, v100, v010, v001, v101, v011, v110, v111]).ravel()
     return i, np.ravel_multi_index(j, shape, mode='clip'), data
 
-def distance_func(func, coords, shape, renorm=True, mp=True):
-    """Generates masks for seperable distance functions"""
+def distance_func(func, coords, shape, renorm=True, mp=True, window=3, chunksize=16384, executor=None):
+    """Generates masks for seperable distance functions
+
+    The 1D kernel `func` is evaluated along x, y and z over the 2*`window` voxels
+    surrounding each vertex, all vertices at once, and the outer products of the
+    three axes are emitted as flat (i, j, data) arrays. Vertices are processed
+    `chunksize` at a time to bound memory; with `mp`, the chunks are spread over
+    the workers of `cortex.mp`. The work happens in vectorized NumPy calls that
+    release the GIL, so the few chunks of a surface usually run on threads.
+    """
     nZ, nY, nX = shape
-    dx = coords[:,0] - np.atleast_2d(np.arange(nX)).T
-    dy = coords[:,1] - np.atleast_2d(np.arange(nY)).T
-    dz = coords[:,2] - np.atleast_2d(np.arange(nZ)).T
-
-    Lx, Ly, Lz = func(dx), func(dy), func(dz)
-    ix, jx = np.nonzero(Lx)
-    iy, jy = np.nonzero(Ly)
-    iz, jz = np.nonzero(Lz)
-    ba = np.broadcast_arrays
-    def func(v):
-        mx, my, mz = ix[jx == v], iy[jy == v], iz[jz == v]
-        idx, idy, idz = [i.ravel() for i in ba(*np.ix_(mx, my, mz))]
-        vx, vy, vz = [i.ravel() for i in ba(*np.ix_(Lx[mx, v], Ly[my, v], Lz[mz, v]))]
-
-        i = v * np.ones((len(idx,)))
-        j = np.ravel_multi_index((idz, idy, idx), shape, mode='clip')
-        data = vx*vy*vz
+    offsets = np.arange(1 - window, window + 1)
+
+    def func_chunk(start, coords=coords):
+        chunk = coords[start:start+chunksize]
+        vidx = np.nonzero(~np.isnan(chunk).any(1))[0]
+        chunk = chunk[vidx]
+
+        # voxel taps and kernel weights along each axis, shape (nverts, 3, ntaps)
+        taps = np.floor(chunk).astype(int)[:,:,np.newaxis] + offsets
+        weights = func(chunk[:,:,np.newaxis] - taps)
+        weights[(taps < 0) | (taps >= np.array([nX, nY, nZ])[:,np.newaxis])] = 0
+        taps = np.clip(taps, 0, np.array([nX, nY, nZ])[:,np.newaxis] - 1)
+
+        # outer product over the three axes, shape (nverts, ntaps, ntaps, ntaps) as (z, y, x)
+        tx, ty, tz = taps[:,0], taps[:,1], taps[:,2]
+        wx, wy, wz = weights[:,0], weights[:,1], weights[:,2]
+        j = (tz[:,:,None,None] * nY + ty[:,None,:,None]) * nX + tx[:,None,None,:]
+        data = wz[:,:,None,None] * wy[:,None,:,None] * wx[:,None,None,:]
         if renorm:
-            data /= data.sum()
-        return i, j, data
+            norm = data.sum((1, 2, 3))
+            norm[norm == 0] = 1
+            data /= norm[:,None,None,None]
+
+        sel = data != 0
+        i = np.broadcast_to((vidx + start)[:,None,None,None], sel.shape)
+        return i[sel], j[sel], data[sel]
 
-    if mp:
+    starts = range(0, len(coords), chunksize)
+    if mp and len(starts) > 1:
         from .. import mp
-        ijdata = mp.map(func, range(len(coords)))
+        ijdata = mp.map(func_chunk, starts, chunksize=1, shared=dict(coords=coords), executor=executor)
     else:
-        #ijdata = map(func, range(len(coords)))
-        ijdata = [func(x) for x in range(len(coords))]
+        ijdata = [func_chunk(x) for x in starts]
 
-    return np.hstack(ijdata)
+    if len(ijdata) == 0:
+        return np.zeros((0,), dtype=int), np.zeros((0,), dtype=int), np.zeros((0,))
+    i, j, data = zip(*ijdata)
+    return np.concatenate(i), np.concatenate(j), np.concatenate(data)
 
 def gaussian(coords, shape, sigma=1, window=3, **kwargs):
-    raise NotImplementedError
     def gaussian(x):
-        pass
-    return distance_func(gaussian, coords, shape, **kwargs)
+        out = np.exp(-x**2 / (2. * sigma**2))
+        out[np.abs(x) >= window] = 0
+        return out
+
+    return distance_func(gaussian, coords, shape, window=window, **kwargs)
 
 def lanczos(coords, shape, window=3, **kwargs):
     def lanczos(x):
-        out = np.zeros_like(x)
-        sel = np.abs(x)<window
-        selx = x[sel]
-        out[sel] = np.sin(np.pi * selx) * np.sin(np.pi * selx / window) * (window / (np.pi**2 * selx**2))
+        out = np.sinc(x) * np.sinc(x / window)
+        out[np.abs(x) >= window] = 0
         return out
 
-    return distance_func(lanczos, coords, shape, **kwargs)
+    return distance_func(lanczos, coords, shape, window=window, **kwargs)
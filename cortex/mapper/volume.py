@@ -6,19 +6,10 @@ from . import samplers
 
 class VolumeMapper(Mapper):
     @classmethod
-    def _cache(cls, filename, subject, xfmname, **kwargs):
-        from .. import db
-        masks = []
-        xfm = db.get_xfm(subject, xfmname, xfmtype='coord')
-        pia = db.get_surf(subject, "pia", merge=False, nudge=False)
-        wm = db.get_surf(subject, "wm", merge=False, nudge=False)
-        
+    def _hemiargs(cls, subject, xfm, coords):
+        pia, wm = coords("pia"), coords("wm")
         #iterate over hemispheres
-        for (wpts, polys), (ppts, _) in zip(pia, wm):
-            masks.append(cls._getmask(xfm(ppts), xfm(wpts), polys, xfm.shape, **kwargs))
-            
-        _savecache(filename, masks[0], masks[1], xfm.shape)
-        return cls(masks[0], masks[1], xfm.shape, subject, xfmname)
+        return [(ppts, wpts, polys, xfm.shape) for (wpts, polys), (ppts, _) in zip(pia, wm)]
 
     @classmethod
     def _getmask(cls, pia, wm, polys, shape, **kwargs):
@@ -37,15 +28,7 @@ class VolumeMapper(Mapper):
         surf = polyutils.Surface(pia, polys)
         samples = mp.map(func, surf.polyconvex(wm))
         #samples = map(func, surf.polyconvex(wm)) ## For debugging
-        ij, data = [], []
-        for i, sample in enumerate(samples):
-            if sample is not None:
-                idx = np.zeros((2, len(sample[0])))
-                idx[0], idx[1] = i, sample[0]
-                ij.append(idx)
-                data.append(sample[1])
-
-        return sparse.csr_matrix((np.hstack(data), np.hstack(ij)), shape=csrshape)
+        return samplers.sparse_rows(samples, csrshape)
 
 class PolyConstMapper(VolumeMapper):
     patchsize = 0.5
@@ -104,13 +87,13 @@ class Polyhedral(VolumeMapper):
 
 class ConvexPolyhedra(VolumeMapper):
     @classmethod
-    def _getmask(cls, pia, wm, polys, shape, npts=1024):
+    def _getmask(cls, pia, wm, polys, shape, npts=1024, executor=None):
         from .. import mp
         from .. import polyutils
         rand = np.random.rand(npts, 3)
         csrshape = len(wm), np.prod(shape)
 
-        def func(pts):
+        def func(pts, rand):
             if len(pts) > 0:
                 #generate points within the bounding box
                 samples = rand * (pts.max(0) - pts.min(0)) + pts.min(0)
@@ -119,17 +102,9 @@ class ConvexPolyhedra(VolumeMapper):
                 return cls._sample(samples[inside], shape, np.sum(inside))
 
         surf = polyutils.Surface(pia, polys)
-        samples = mp.map(func, surf.polyconvex(wm))
-        #samples = map(func, surf.polyconvex(wm)) ## For debugging
-        ij, data = [], []
-        for i, sample in enumerate(samples):
-            if sample is not None:
-                idx = np.zeros((2, len(sample[0])))
-                idx[0], idx[1] = i, sample[0]
-                ij.append(idx)
-                data.append(sample[1])
-
-        return sparse.csr_matrix((np.hstack(data), np.hstack(ij)), shape=csrshape)
+        samples = mp.map(func, surf.polyconvex(wm), shared=dict(rand=rand), executor=executor)
+        #samples = [func(pts, rand) for pts in surf.polyconvex(wm)] ## For debugging
+        return samplers.sparse_rows(samples, csrshape)
 
 class ConvexNN(VolumeMapper):
     @staticmethod
@@ -141,7 +116,7 @@ class ConvexNN(VolumeMapper):
         valid = np.logical_and(d1, np.logical_and(d2, d3))
         if valid.any():
             idx = np.ravel_multi_index(coords[valid].T, shape)
-            j, data = np.array(Counter(idx).items()).T
+            j, data = samplers.collapse(idx, np.ones((len(idx),)))
             return j, data / float(norm)
 
 class ConvexTrilin(VolumeMapper):
@@ -175,9 +150,7 @@ class ConvexTrilin(VolumeMapper):
         allj = np.vstack([i000, i100, i010, i001, i101, i011, i110, i111]).T.ravel()
         data = np.vstack([v000, v100, v010, v001, v101, v011, v110, v111]).T.ravel()
 
-        uniquej = np.unique(allj)
-        uniquejdata = np.array([data[allj==j].sum() for j in uniquej])
-        
+        uniquej, uniquejdata = samplers.collapse(allj, data)
         return uniquej, uniquejdata / float(norm)
 
 
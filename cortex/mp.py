@@ -1,59 +1,284 @@
-import sys
-import marshal
+import pickle
+import warnings
+import itertools
 import multiprocessing as mp
+
+import numpy as np
+
+from . import options
+from . import profiling
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    shared_memory = None
 try:
     import progressbar as pb
 except ImportError:
     pass
 
-def map(func, iterable, procs = mp.cpu_count()):
-    input, output = mp.Queue(), mp.Queue()
-    length = mp.Value('i',0)
-    
-    def _fill(iterable, procs, input, output):
-        for data in enumerate(iterable):
-            input.put(data)
-            length.value += 1
-        for _ in range(procs*2):
-            input.put((-1,-1))
-        
-    def _func(proc, input, output):
-        idx, data = input.get()
-        while idx != -1:
-            output.put((idx, func(data)))
-            idx, data = input.get()
-    
-    filler = mp.Process(target = _fill, args=(iterable, procs, input, output))
-    filler.daemon = True
-    filler.start()
-    for i in range(procs):
-        proc = mp.Process(target=_func, args=(i, input, output))
-        proc.daemon = True
-        proc.start()
-    
+#Function installed by the pool initializer, for functions that cannot be pickled
+_worker_func = None
+#Shared memory blocks attached by this worker, by block name
+_worker_arrays = dict()
+
+def _init_worker(func):
+    global _worker_func
+    _worker_func = func
+
+def _attach(handles):
+    """Attaches the shared arrays described by `handles` in a worker, dropping
+    the blocks of previous calls"""
+    names = set(shmname for shmname, _, _ in handles.values())
+    for shmname in list(_worker_arrays):
+        if shmname not in names:
+            _worker_arrays.pop(shmname)[0].close()
+
+    arrays = dict()
+    for key, (shmname, shape, dtype) in handles.items():
+        if shmname not in _worker_arrays:
+            # The workers share the resource tracker of the parent, started
+            # before them by `Executor._start_pool`, so attaching only repeats
+            # the parent's registration, which its `unlink` removes
+            shm = shared_memory.SharedMemory(name=shmname)
+            arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            arr.flags.writeable = False
+            _worker_arrays[shmname] = shm, arr
+        arrays[key] = _worker_arrays[shmname][1]
+    return arrays
+
+def _run_chunk(args):
+    func, handles, chunk = args
+    if func is None:
+        func = _worker_func
+    # Without shared memory, the arrays themselves come with every chunk
+    arrays = handles if shared_memory is None else _attach(handles)
+    return [func(item, **arrays) for item in chunk]
+
+def _picklable(func):
     try:
-        iterlen = len(iterable)
-    except:
-        filler.join()
-        iterlen = length.value
+        pickle.dumps(func)
+        return True
+    except Exception:
+        return False
+
+def _chunks(iterable, chunksize):
+    iterable = iter(iterable)
+    chunk = list(itertools.islice(iterable, chunksize))
+    while len(chunk) > 0:
+        yield chunk
+        chunk = list(itertools.islice(iterable, chunksize))
+
+def _process_threshold():
+    return options.config.getint("mp", "process_threshold", fallback=256)
+
+class Executor(object):
+    """Pool of workers mapping a function over chunks of items.
+
+    Items are sent to the workers `chunksize` at a time, and large read-only
+    arrays passed as `shared` are copied once into shared memory and handed to
+    the function as keyword arguments. Thread workers, and process workers for
+    picklable functions, are started on first use and kept across calls until
+    `close`, so the executor can be reused by several mappers. Functions that
+    cannot be pickled, such as closures, only reach process workers through
+    fork, so every call forks a pool of its own for them. Use the executor as a
+    context manager to release the workers.
+
+    Without `multiprocessing.shared_memory`, the `shared` arrays are pickled with
+    every chunk instead.
+
+    Parameters
+    ----------
+    procs : int, optional
+        Number of workers. Defaults to the number of CPUs.
+    context : str, optional
+        Start method of the worker processes: 'fork', 'spawn' or 'forkserver'.
+        Defaults to the platform default. Functions that cannot be pickled, such
+        as closures, need 'fork'; with other start methods they run in this
+        process, with a RuntimeWarning.
+    backend : str, optional
+        'inline', 'thread', 'process' or 'auto' (default). 'auto' runs in this
+        process with a single worker or item, on threads for fewer items than
+        the `process_threshold` option of the [mp] config section, and on
+        processes otherwise. Threads suit functions spending their time in
+        vectorized NumPy calls, which release the GIL.
+    """
+    def __init__(self, procs=None, context=None, backend="auto"):
+        self.procs = procs or mp.cpu_count()
+        self.context = mp.get_context(context)
+        self.backend = backend
+        self._pool = None
+        self._threads = None
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = self._start_pool()
+        return self._pool
+
+    def _start_pool(self, *args):
+        # Start the resource tracker first so that the workers share it
+        if shared_memory is not None:
+            resource_tracker.ensure_running()
+        return self.context.Pool(self.procs, *args)
+
+    @property
+    def threads(self):
+        if self._threads is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._threads = ThreadPoolExecutor(self.procs)
+        return self._threads
 
-    data = [[]]*iterlen
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        if self._threads is not None:
+            self._threads.shutdown()
+            self._threads = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _chunksize(self, iterable):
+        try:
+            return max(1, len(iterable) // (self.procs * 4))
+        except TypeError:
+            return 16
+
+    def select_backend(self, iterable, backend=None):
+        """Resolves the backend used to map over `iterable`"""
+        backend = self.backend if backend is None else backend
+        if backend != "auto":
+            return backend
+        try:
+            nitems = len(iterable)
+        except TypeError:
+            return "process" if self.procs > 1 else "inline"
+
+        if self.procs == 1 or nitems <= 1:
+            return "inline"
+        if nitems < _process_threshold():
+            return "thread"
+        return "process"
+
+    def imap(self, func, iterable, chunksize=None, shared=None, backend=None):
+        """Maps `func` over `iterable`, yielding the results in order as they
+        arrive.
+
+        Parameters
+        ----------
+        func : callable
+            Called as func(item, **shared) for each item.
+        iterable : iterable
+            Items to process.
+        chunksize : int, optional
+            Number of items sent to a worker at once. Defaults to a quarter of
+            the items per worker.
+        shared : dict, optional
+            Read-only arrays shared with every call of `func`, by keyword.
+        backend : str, optional
+            Overrides the backend of the executor for this call.
+        """
+        backend = self.select_backend(iterable, backend)
+        if chunksize is None:
+            chunksize = self._chunksize(iterable)
+        shared = dict() if shared is None else shared
+        chunks = _chunks(iterable, chunksize)
+
+        if backend == "process" and _picklable(func):
+            pool, init = self.pool, func
+        elif backend == "process" and self.context.get_start_method() == "fork":
+            # Closures reach the workers through fork, so they need their own pool
+            pool, init = self._start_pool(_init_worker, (func,)), None
+        elif backend == "process":
+            warnings.warn("%r cannot be pickled for %r workers; running it in this "
+                          "process" % (func, self.context.get_start_method()), RuntimeWarning)
+            backend = "inline"
+
+        if backend == "thread":
+            run = lambda chunk: [func(item, **shared) for item in chunk]
+            for results in self.threads.map(run, chunks):
+                for result in results:
+                    yield result
+            return
+        elif backend != "process":
+            for chunk in chunks:
+                for item in chunk:
+                    yield func(item, **shared)
+            return
+
+        blocks, handles = [], shared
+        try:
+            if shared_memory is not None:
+                handles = dict()
+                for key, arr in shared.items():
+                    arr = np.ascontiguousarray(arr)
+                    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+                    blocks.append(shm)
+                    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[:] = arr
+                    handles[key] = shm.name, arr.shape, arr.dtype.str
+
+            for results in pool.imap(_run_chunk, ((init, handles, chunk) for chunk in chunks)):
+                for result in results:
+                    yield result
+        finally:
+            if pool is not self._pool:
+                pool.terminate()
+                pool.join()
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+
+    def map(self, func, iterable, chunksize=None, shared=None, backend=None):
+        """Maps `func` over `iterable` like `imap`, returning a list"""
+        return list(self.imap(func, iterable, chunksize=chunksize, shared=shared, backend=backend))
+
+def imap(func, iterable, procs=None, chunksize=None, shared=None, executor=None, backend=None):
+    """Maps `func` over `iterable` in worker threads or processes, yielding the
+    results in order. Runs on `executor` if given, otherwise on workers started
+    for this call. `backend` defaults to the backend of `executor`, or 'auto'.
+    See `Executor` and `Executor.imap` for the arguments."""
+    if executor is not None:
+        for result in executor.imap(func, iterable, chunksize=chunksize, shared=shared,
+                                    backend=backend):
+            yield result
+        return
+
+    with Executor(procs, backend=backend or "auto") as executor:
+        for result in executor.imap(func, iterable, chunksize=chunksize, shared=shared):
+            yield result
+
+def map(func, iterable, procs=None, chunksize=None, shared=None, executor=None, backend=None):
+    """Maps `func` over `iterable` in worker threads or processes, returning a
+    list of the results in order. See `Executor` and `Executor.imap` for the
+    arguments."""
     try:
-        progress = pb.ProgressBar(widgets=[pb.Percentage(), pb.Bar()], maxval=iterlen)
+        iterlen = len(iterable)
+    except TypeError:
+        iterable = list(iterable)
+        iterlen = len(iterable)
+
+    name = getattr(func, "__qualname__", getattr(func, "__name__", repr(func)))
+    with profiling.timer("mp.map", func=name) as timer:
+        timer.items = iterlen
+        results = imap(func, iterable, procs=procs, chunksize=chunksize, shared=shared,
+                       executor=executor, backend=backend)
+        try:
+            progress = pb.ProgressBar(widgets=[pb.Percentage(), pb.Bar()], maxval=iterlen)
+        except NameError:
+            return list(results)
+
+        data = []
         progress.start()
-        for i in range(iterlen):
-            idx, result = output.get()
-            data[idx] = result
-            progress.update(i+1)
+        for result in results:
+            data.append(result)
+            progress.update(len(data))
         progress.finish()
-    except NameError:
-        for _ in range(iterlen):
-            idx, result = output.get()
-            data[idx] = result
-        
-    return data
+        return data
 
 if __name__ == "__main__":
-    #pool = Pool()
-    #data = pool.map(
-    map(lambda x: max(x), zip(*(iter(range(65536)),)*3))
+    print(len(map(max, zip(*(iter(range(65536)),)*3))))
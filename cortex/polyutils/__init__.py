@@ -11,7 +11,9 @@ from .misc import (
     inside_convex_poly,
     make_cube,
     boundary_edges,
+    boundary_loops,
     trace_poly,
+    scanline_rasterize,
     rasterize,
     voxelize,
     measure_volume,
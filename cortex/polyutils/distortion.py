@@ -77,25 +77,39 @@ class Distortion(object):
         vertdists : 1D ndarray, shape (total_verts,)
             Metric distortion at each vertex.
         """
-        import networkx as nx
-        def iter_surfedges(tris):
-            for a,b,c in tris:
-                yield a,b
-                yield b,c
-                yield a,c
-
-        def make_surface_graph(tris):
-            graph = nx.Graph()
-            graph.add_edges_from(iter_surfedges(tris))
-            return graph
-
-        G = make_surface_graph(self.polys)
-        selverts = np.unique(self.polys.ravel())
-        ref_dists = [np.sqrt(((self.ref[np.array([x for x in G.neighbors(ii)])] - 
-                               self.ref[ii])**2).sum(1)) for ii in selverts]
-        flat_dists = [np.sqrt(((self.flat[np.array([x for x in G.neighbors(ii)])] - 
-                                self.flat[ii])**2).sum(1)) for ii in selverts]
-        msdists = np.array([(f-r).mean() for r,f in zip(ref_dists, flat_dists)])
-        alldists = np.zeros((len(self.ref),))
-        alldists[selverts] = msdists
+        # Each edge of the mesh once, then its length change counted at both ends
+        nverts = len(self.ref)
+        edges = np.vstack([self.polys[:,[0,1]], self.polys[:,[1,2]], self.polys[:,[2,0]]])
+        edges = np.sort(edges, axis=1).astype(np.int64)
+        keys = np.unique(edges[:,0] * nverts + edges[:,1])
+        edges = np.vstack([keys // nverts, keys % nverts]).T
+        diff = _lengths(self.flat, edges) - _lengths(self.ref, edges)
+
+        ends = edges.T.ravel()
+        counts = np.bincount(ends, minlength=nverts)
+        sums = np.bincount(ends, np.tile(diff, 2), minlength=nverts)
+        alldists = np.zeros((nverts,))
+        selverts = counts > 0
+        alldists[selverts] = sums[selverts] / counts[selverts]
         return alldists
+
+    @property
+    def face_metric(self):
+        """Compute metric distortion of the flatmap at each triangle, as the
+        mean difference in length of its three edges between the flatmap and
+        the reference. See `metric`.
+
+        Returns
+        -------
+        facedists : 1D ndarray, shape (total_polys,)
+            Metric distortion at each triangle.
+        """
+        facedists = np.zeros((len(self.polys),))
+        for i, j in [(0, 1), (1, 2), (2, 0)]:
+            edges = self.polys[:,[i, j]]
+            facedists += _lengths(self.flat, edges) - _lengths(self.ref, edges)
+        return facedists / 3
+
+def _lengths(pts, edges):
+    """Length of each edge, given as pairs of vertex indices"""
+    return np.sqrt(((pts[edges[:,1]] - pts[edges[:,0]])**2).sum(1))
@@ -20,20 +20,49 @@ class ExactGeodesicException(Exception):
 class ExactGeodesicMixin(object):
     """Mixin for computing exact geodesic distance along surface"""
 
-    def exact_geodesic_distance(self, vertex):
+    def exact_geodesic_distance(self, vertex, max_distance=np.inf):
         """Compute exact geodesic distance along surface
 
         - uses VTP geodesic algorithm
+        - see fmm_geodesic_distance() for a faster approximation
 
         Parameters
         ----------
         - vertex : int or list of int
             index of vertex or vertices to compute geodesic distance from
+        - max_distance : float
+            distances beyond this are reported as inf
         """
-        if isinstance(vertex, list):
-            return np.vstack(self.exact_geodesic_distance(v) for v in vertex).min(0)
+        if isinstance(vertex, (list, tuple, np.ndarray)):
+            distances = np.vstack([self.call_vtp_geodesic(v) for v in vertex]).min(0)
         else:
-            return self.call_vtp_geodesic(vertex)
+            distances = self.call_vtp_geodesic(vertex)
+        distances[distances > max_distance] = np.inf
+        return distances
+
+    def fmm_geodesic_distance(self, vertex, max_distance=np.inf):
+        """Compute approximate geodesic distance along surface by fast marching
+
+        - runs the compiled cortex.polyutils.fmm in this process, from all
+          vertices at once
+        - propagates across the faces, so it is much closer to the exact
+          distance than distances along the mesh edges, but not exact
+
+        Parameters
+        ----------
+        - vertex : int or list of int
+            index of vertex or vertices to compute geodesic distance from
+        - max_distance : float
+            stop propagating beyond this distance, reporting further vertices as inf
+        """
+        try:
+            from . import fmm
+        except ImportError:
+            raise ExactGeodesicException('cortex.polyutils.fmm is not compiled')
+
+        connected = self.connected
+        return fmm.geodesic_distance(self.pts, self.polys, vertex, max_distance,
+                                     vertex_faces=(connected.indptr, connected.indices))
 
     def call_vtp_geodesic(self, vertex):
         """Compute geodesic distance using VTP method
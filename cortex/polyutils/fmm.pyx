@@ -0,0 +1,226 @@
+# distutils: language = c++
+"""Fast marching geodesic distances on triangle meshes.
+
+Distances are propagated outwards from the sources in order, as in Dijkstra's
+algorithm, but each vertex is updated across the faces it shares with two
+finalized vertices. The update unfolds the face into the plane and measures the
+straight line from the virtual source reproducing the distances of the two
+finalized vertices, so that distances are not restricted to the edges of the
+mesh. When that line does not cross the opposite edge, the vertex is updated
+along the edges instead [Kimmel & Sethian 1998, Novotni & Klein 2002].
+"""
+import numpy as np
+
+cimport cython
+cimport numpy as np
+from libc.math cimport sqrt, INFINITY
+from libcpp.vector cimport vector
+from libcpp.queue cimport priority_queue
+from libcpp.utility cimport pair
+
+np.import_array()
+
+ctypedef pair[double, np.int64_t] entry
+
+cdef enum:
+    FAR = 0
+    TRIAL = 1
+    KNOWN = 2
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline double _norm(double[:, ::1] pts, np.int64_t a, np.int64_t b) nogil:
+    cdef double dx = pts[a, 0] - pts[b, 0]
+    cdef double dy = pts[a, 1] - pts[b, 1]
+    cdef double dz = pts[a, 2] - pts[b, 2]
+    return sqrt(dx*dx + dy*dy + dz*dz)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline double _update(double[:, ::1] pts, double[::1] dist,
+                           np.int64_t a, np.int64_t b, np.int64_t c) nogil:
+    """Distance of vertex c through the face abc, from finalized a and b"""
+    cdef double ta = dist[a], tb = dist[b]
+    cdef double ab = _norm(pts, a, b), ac = _norm(pts, a, c), bc = _norm(pts, b, c)
+    cdef double edge = min(ta + ac, tb + bc)
+    cdef double sx, sy2, sy, cx, cy2, cy, x0
+    if ab <= 0:
+        return edge
+
+    # Unfold with a at the origin, b on the x axis and c above it; the virtual
+    # source lies below the x axis at distances ta and tb from a and b
+    sx = (ta*ta - tb*tb + ab*ab) / (2 * ab)
+    sy2 = ta*ta - sx*sx
+    cx = (ac*ac - bc*bc + ab*ab) / (2 * ab)
+    cy2 = ac*ac - cx*cx
+    if sy2 < 0 or cy2 <= 0:
+        return edge
+    sy = -sqrt(sy2)
+    cy = sqrt(cy2)
+
+    # The straight line from the source must enter the face through ab
+    x0 = sx + (cx - sx) * (-sy) / (cy - sy)
+    if x0 < 0 or x0 > ab:
+        return edge
+    return min(edge, sqrt((cx - sx)**2 + (cy - sy)**2))
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _march(double[:, ::1] pts, np.int64_t[:, ::1] polys,
+                 np.int64_t[::1] indptr, np.int64_t[::1] faces,
+                 np.int64_t[::1] sources, double max_distance,
+                 double[::1] dist, signed char[::1] state,
+                 vector[np.int64_t]& touched) nogil:
+    cdef priority_queue[entry] heap
+    cdef entry top
+    cdef np.int64_t i, j, k, f, v, w, u
+    cdef double d, cand
+
+    for i in range(sources.shape[0]):
+        v = sources[i]
+        if state[v] == FAR:
+            touched.push_back(v)
+        dist[v] = 0
+        state[v] = TRIAL
+        heap.push(entry(0., v))
+
+    while not heap.empty():
+        top = heap.top()
+        heap.pop()
+        d, v = -top.first, top.second
+        if state[v] == KNOWN or d > dist[v]:
+            continue
+        if d > max_distance:
+            break
+        state[v] = KNOWN
+
+        for i in range(indptr[v], indptr[v+1]):
+            f = faces[i]
+            for j in range(3):
+                w = polys[f, j]
+                if w == v or state[w] == KNOWN:
+                    continue
+                for k in range(3):
+                    u = polys[f, k]
+                    if u != v and u != w:
+                        break
+
+                cand = dist[v] + _norm(pts, v, w)
+                if state[u] == KNOWN:
+                    cand = min(cand, _update(pts, dist, v, u, w))
+                if cand < dist[w]:
+                    if state[w] == FAR:
+                        touched.push_back(w)
+                        state[w] = TRIAL
+                    dist[w] = cand
+                    heap.push(entry(-cand, w))
+
+
+def _vertex_faces(polys, nverts):
+    """Faces around each vertex, as CSR index pointers and face indices"""
+    order = np.argsort(polys.ravel(), kind="mergesort")
+    counts = np.bincount(polys.ravel(), minlength=nverts)
+    indptr = np.zeros(nverts + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    return indptr, (order // 3).astype(np.int64)
+
+
+def _prepare(pts, polys, vertex_faces):
+    pts = np.ascontiguousarray(pts, dtype=np.float64)
+    polys = np.ascontiguousarray(polys, dtype=np.int64)
+    if vertex_faces is None:
+        vertex_faces = _vertex_faces(polys, len(pts))
+    indptr, faces = [np.ascontiguousarray(x, dtype=np.int64) for x in vertex_faces]
+    return pts, polys, indptr, faces
+
+
+def geodesic_distance(pts, polys, sources, max_distance=np.inf, vertex_faces=None):
+    """Geodesic distance from the nearest of `sources` to every vertex.
+
+    Parameters
+    ----------
+    pts : array_like, shape (npts, 3)
+        Vertex coordinates.
+    polys : array_like, shape (npolys, 3)
+        Triangles, as vertex indices.
+    sources : int or array_like of int
+        Source vertices.
+    max_distance : float, optional
+        Stop propagating beyond this distance. Vertices further away are
+        reported at infinity.
+    vertex_faces : tuple of ndarray, optional
+        Faces around each vertex as CSR (indptr, indices), such as those of
+        `Surface.connected`. Computed from `polys` if not given.
+
+    Returns
+    -------
+    dist : ndarray, shape (npts,)
+    """
+    cdef double[:, ::1] P
+    cdef np.int64_t[:, ::1] F
+    cdef np.int64_t[::1] indptr, faces
+    P, F, indptr, faces = _prepare(pts, polys, vertex_faces)
+    cdef np.int64_t[::1] srcs = np.atleast_1d(sources).astype(np.int64)
+    dist = np.full(len(pts), np.inf)
+    state = np.zeros(len(pts), dtype=np.int8)
+    cdef vector[np.int64_t] touched
+    cdef double limit = max_distance
+    cdef double[::1] dview = dist
+    cdef signed char[::1] sview = state
+    with nogil:
+        _march(P, F, indptr, faces, srcs, limit, dview, sview, touched)
+    dist[dist > max_distance] = np.inf
+    return dist
+
+
+def geodesic_neighborhoods(pts, polys, seeds, radius, vertex_faces=None):
+    """Vertices within `radius` of each seed, with their geodesic distances.
+    See `geodesic_distance` for the arguments.
+
+    Returns
+    -------
+    indptr, indices, data : ndarray
+        One row per seed, in compressed sparse row layout.
+    """
+    cdef double[:, ::1] P
+    cdef np.int64_t[:, ::1] F
+    cdef np.int64_t[::1] indptr, faces
+    P, F, indptr, faces = _prepare(pts, polys, vertex_faces)
+    cdef np.int64_t[::1] seedv = np.atleast_1d(seeds).astype(np.int64)
+    dist = np.full(len(pts), np.inf)
+    state = np.zeros(len(pts), dtype=np.int8)
+    cdef double[::1] dview = dist
+    cdef signed char[::1] sview = state
+    cdef np.int64_t[::1] src = np.zeros(1, dtype=np.int64)
+    cdef vector[np.int64_t] touched
+    cdef double limit = radius
+    cdef np.int64_t i, j, v
+    cdef vector[np.int64_t] cols
+    cdef vector[double] vals
+
+    rows = np.zeros(len(seedv) + 1, dtype=np.int64)
+    for i in range(seedv.shape[0]):
+        src[0] = seedv[i]
+        touched.clear()
+        with nogil:
+            _march(P, F, indptr, faces, src, limit, dview, sview, touched)
+        for j in range(<np.int64_t>touched.size()):
+            v = touched[j]
+            if dview[v] <= limit:
+                cols.push_back(v)
+                vals.push_back(dview[v])
+            dview[v] = INFINITY
+            sview[v] = FAR
+        rows[i+1] = cols.size()
+
+    indices = np.empty(cols.size(), dtype=np.int64)
+    data = np.empty(vals.size(), dtype=np.float64)
+    cdef np.int64_t[::1] iview = indices
+    cdef double[::1] vview = data
+    for j in range(<np.int64_t>cols.size()):
+        iview[j] = cols[j]
+        vview[j] = vals[j]
+    return rows, indices, data
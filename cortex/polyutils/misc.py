@@ -87,20 +87,120 @@ def make_cube(center=(.5, .5, .5), size=1):
 
 def boundary_edges(polys):
     '''Returns the edges that are on the boundary of a mesh, as defined by belonging to only 1 face'''
-    edges = dict()
-    for i, poly in enumerate(np.sort(polys)):
-        for a, b in [(0,1), (1,2), (0, 2)]:
-            key = poly[a], poly[b]
-            if key not in edges:
-                edges[key] = []
-            edges[key].append(i)
+    spolys = np.sort(polys).astype(np.int64)
+    edges = np.vstack([spolys[:,[0,1]], spolys[:,[1,2]], spolys[:,[0,2]]])
+    nverts = spolys.max() + 1 if len(spolys) > 0 else 0
+    keys, index, counts = np.unique(edges[:,0] * nverts + edges[:,1],
+                                    return_index=True, return_counts=True)
+    return edges[np.sort(index[counts == 1])]
 
-    epts = []
-    for edge, faces in edges.items():
-        if len(faces) == 1:
-            epts.append(edge)
+def boundary_loops(polys):
+    """Returns the closed loops of vertices bounding a mesh, longest first.
 
-    return np.array(epts)
+    Each boundary edge is followed in the direction it has in its face, so for
+    consistently oriented faces, holes run the opposite way to the outer
+    boundary. Separate components and holes give separate loops; a vertex
+    where several loops touch appears in each of them.
+
+    Parameters
+    ----------
+    polys : 2D ndarray, shape (total_polys, 3)
+        Triangle vertex indices.
+
+    Returns
+    -------
+    loops : list of 1D ndarray
+        Vertex indices of each loop, without repeating the first vertex.
+    """
+    polys = np.asarray(polys, dtype=np.int64)
+    if len(polys) == 0:
+        return []
+    nverts = polys.max() + 1
+    heads = polys.ravel()
+    tails = polys[:,[1,2,0]].ravel()
+    # Half-edges whose reverse is in no face lie on the boundary
+    border = ~np.in1d(heads * nverts + tails, tails * nverts + heads)
+    heads, tails = heads[border], tails[border]
+
+    # Chain each half-edge to one leaving the vertex it arrives at; pairing the
+    # k-th arriving with the k-th leaving edge of each vertex keeps this a
+    # permutation where loops touch
+    outgoing = np.argsort(heads, kind="mergesort")
+    incoming = np.argsort(tails, kind="mergesort")
+    succ = np.empty(len(heads), dtype=np.int64)
+    succ[incoming] = outgoing
+
+    loops, seen = [], np.zeros(len(heads), dtype=bool)
+    for start in range(len(heads)):
+        if seen[start]:
+            continue
+        loop, edge = [], start
+        while not seen[edge]:
+            seen[edge] = True
+            loop.append(edge)
+            edge = succ[edge]
+        loops.append(heads[loop])
+    loops.sort(key=len, reverse=True)
+    return loops
+
+def scanline_rasterize(pts, edges, shape, supersample=1):
+    """Fills the regions enclosed by a set of edges, such as the boundary of a
+    flat mesh, with the even-odd rule, so that holes stay empty.
+
+    Each row of pixels is intersected with all edges at once, and pixels whose
+    centers lie between alternate crossings are filled. Pixel (i, j) covers
+    [j, j+1) x [i, i+1) in the coordinates of `pts`.
+
+    Parameters
+    ----------
+    pts : 2D ndarray, shape (npts, 2)
+        x, y location of the vertices, in pixels.
+    edges : 2D ndarray, shape (nedges, 2)
+        Vertex indices of each edge. Each enclosed region must be closed.
+    shape : tuple of int
+        Size of the image, (rows, columns).
+    supersample : int, optional
+        Number of samples along each axis of a pixel. Above 1, the fraction of
+        the pixel that is covered is returned.
+
+    Returns
+    -------
+    image : 2D ndarray, shape `shape`
+        Boolean mask of the filled pixels, or coverage between 0 and 1 with
+        `supersample`.
+    """
+    nrows, ncols = shape[0] * supersample, shape[1] * supersample
+    edges = np.asarray(edges)
+    start = pts[edges[:,0],:2] * supersample
+    end = pts[edges[:,1],:2] * supersample
+    # Orient edges downwards and drop horizontal ones, which no row crosses
+    flip = start[:,1] > end[:,1]
+    start[flip], end[flip] = end[flip], start[flip]
+    keep = start[:,1] < end[:,1]
+    start, end = start[keep], end[keep]
+
+    # Rows whose centers lie in [start, end) of each edge
+    first = np.clip(np.ceil(start[:,1] - .5), 0, nrows).astype(np.int64)
+    last = np.clip(np.ceil(end[:,1] - .5), 0, nrows).astype(np.int64)
+    counts = np.maximum(last - first, 0)
+    edge = np.repeat(np.arange(len(start)), counts)
+    rows = first[edge] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    slope = (end[:,0] - start[:,0]) / (end[:,1] - start[:,1])
+    xs = start[edge,0] + (rows + .5 - start[edge,1]) * slope[edge]
+
+    # Every closed region crosses each row an even number of times
+    order = np.lexsort((xs, rows))
+    rows, xs = rows[order].reshape(-1, 2), xs[order].reshape(-1, 2)
+    left = np.clip(np.ceil(xs[:,0] - .5), 0, ncols).astype(np.int64)
+    right = np.clip(np.ceil(xs[:,1] - .5), 0, ncols).astype(np.int64)
+    spans = np.zeros((nrows, ncols + 1), dtype=np.int32)
+    np.add.at(spans, (rows[:,0], left), 1)
+    np.add.at(spans, (rows[:,0], right), -1)
+    image = np.cumsum(spans[:,:-1], axis=1) > 0
+
+    if supersample == 1:
+        return image
+    return image.reshape(shape[0], supersample, shape[1], supersample).mean((1, 3))
 
 def trace_poly(edges):
     """Returns the two largest connected components, out of a set of boundary
@@ -158,38 +258,136 @@ def rasterize(poly, shape=(256, 256)):
     # return np.zeros(shape, dtype=bool)
     return (np.array(im)[:,:,0] > 128).T
 
-def voxelize(pts, polys, shape=(256, 256, 256), center=(128, 128, 128), mp=True):
-    from tvtk.api import tvtk
-    
-    pd = tvtk.PolyData(points=pts + center + (0, 0, 0), polys=polys)
-    plane = tvtk.Planes(normals=[(0,0,1)], points=[(0,0,0)])
-    clip = tvtk.ClipPolyData(clip_function=plane, input=pd)
-    feats = tvtk.FeatureEdges(
-        manifold_edges=False, 
-        non_manifold_edges=False, 
-        feature_edges=False,
-        boundary_edges=True,
-        input=clip.output)
-
-    def func(i):
-        plane.points = [(0,0,i)]
-        feats.update()
-        vox = np.zeros(shape[:2][::-1], np.uint8)
-        if feats.output.number_of_lines > 0:
-            epts = feats.output.points.to_array()
-            edges = feats.output.lines.to_array().reshape(-1, 3)[:,1:]
-            for poly in trace_poly(edges):
-                vox += rasterize(epts[poly][:,:2]+[.5, .5], shape=shape[:2][::-1])
-        return vox % 2
+def _edge_sides(pts, i, j, px, py):
+    """Side of the points (px, py) relative to the edges i->j of the triangles,
+    projected on the xy plane: +1 on the left, -1 on the right.
+
+    The edge function is always evaluated from the lower vertex index, so that
+    the faces sharing an edge see exactly opposite values. Points on an edge are
+    moved to the side they would be on after an infinitesimal shift along
+    (1, epsilon), so each point lies strictly inside exactly one of the faces
+    around it."""
+    lo, hi = np.minimum(i, j), np.maximum(i, j)
+    flip = np.where(i < j, 1., -1.)
+    dx = (pts[hi,0] - pts[lo,0]) * flip
+    dy = (pts[hi,1] - pts[lo,1]) * flip
+    w = ((pts[hi,0] - pts[lo,0]) * (py - pts[lo,1]) - (pts[hi,1] - pts[lo,1]) * (px - pts[lo,0])) * flip
+    side = np.sign(w)
+    tie = side == 0
+    side[tie] = np.where(dy[tie] != 0, -np.sign(dy[tie]), np.sign(dx[tie]))
+    return side, w
+
+def _ray_crossings(pts, polys, size):
+    """Heights at which the rays along z through the integer (x, y) points of a
+    grid of `size` cross the triangles `polys`, with the flat index of each ray"""
+    lower = np.ceil(pts[polys,:2].min(1)).astype(np.int64).clip(0)
+    upper = np.floor(pts[polys,:2].max(1)).astype(np.int64).clip(max=np.array(size) - 1)
+    extent = (upper - lower + 1).clip(0)
+    counts = extent.prod(1)
+    tri = np.repeat(np.arange(len(polys)), counts)
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    px = lower[tri,0] + local % extent[tri,0]
+    py = lower[tri,1] + local // extent[tri,0]
+
+    a, b, c = polys[tri].T
+    sab, wab = _edge_sides(pts, a, b, px, py)
+    sbc, wbc = _edge_sides(pts, b, c, px, py)
+    sca, wca = _edge_sides(pts, c, a, px, py)
+    inside = (sab == sbc) & (sbc == sca) & (sab != 0)
+    wab, wbc, wca = wab[inside], wbc[inside], wca[inside]
+    a, b, c = a[inside], b[inside], c[inside]
+    total = wab + wbc + wca
+    total[total == 0] = 1
+    zs = (wbc * pts[a,2] + wca * pts[b,2] + wab * pts[c,2]) / total
+    return px[inside] * size[1] + py[inside], zs
+
+def voxelize(pts, polys, shape=(256, 256, 256), center=(128, 128, 128), mp=True,
+             partial=False, supersample=4, chunksize=65536):
+    """Voxelizes the volume enclosed by a closed surface.
+
+    Rays are cast along z through the centers of the voxels, and the voxels
+    between alternate crossings of each ray with the surface are filled. Points
+    on the edges or vertices of the triangles are attributed to exactly one
+    triangle, so the result is exact for closed manifolds.
 
+    Parameters
+    ----------
+    pts : 2D ndarray, shape (total_verts, 3)
+        Location of each vertex, in voxels.
+    polys : 2D ndarray, shape (total_polys, 3)
+        Triangle vertex indices.
+    shape : tuple of int, optional
+        Size of the volume, in (x, y, z) order.
+    center : tuple of float, optional
+        Offset added to `pts`.
+    mp : bool, optional
+        Process chunks of triangles through `cortex.mp`.
+    partial : bool, optional
+        Return the fraction of each voxel inside the surface. It is exact along
+        z, and sampled over `supersample` by `supersample` rays in x and y.
+    supersample : int, optional
+        Rays per voxel along x and y for `partial`.
+    chunksize : int, optional
+        Number of triangles processed at once.
+
+    Returns
+    -------
+    vox : 3D ndarray, shape `shape`
+        Mask of the voxels inside the surface as uint8, or float32 fractions
+        with `partial`.
+    """
+    pts = np.asarray(pts, dtype=np.float64) + center
+    polys = np.asarray(polys, dtype=np.int64)
+    nsub = supersample if partial else 1
+    if nsub > 1:
+        pts[:,:2] = nsub * (pts[:,:2] + .5) - .5
+    size = shape[0] * nsub, shape[1] * nsub
+
+    func = lambda start: _ray_crossings(pts, polys[start:start+chunksize], size)
+    starts = range(0, len(polys), chunksize)
     if mp:
-        from . import mp
-        layers = mp.map(func, range(shape[2]))
+        from .. import mp as cmp
+        chunks = cmp.map(func, starts)
     else:
-        #layers = map(func, range(shape[2]))
-        layers = [func(x) for x in range(shape[2])] # python3 compatible
-
-    return np.array(layers).T
+        chunks = [func(start) for start in starts]
+    rays = np.hstack([np.asarray(ch[0], dtype=np.int64) for ch in chunks] + [np.zeros(0, np.int64)])
+    zs = np.hstack([ch[1] for ch in chunks] + [np.zeros(0)])
+
+    order = np.lexsort((zs, rays))
+    rays, zs = rays[order], zs[order]
+    if len(rays) % 2 != 0 or np.any(rays[0::2] != rays[1::2]):
+        raise ValueError("Surface is not closed")
+    rays, z0, z1 = rays[0::2], zs[0::2], zs[1::2]
+
+    nz = shape[2]
+    if not partial:
+        # Voxels whose centers lie in [z0, z1)
+        first = np.ceil(z0).clip(0, nz).astype(np.int64)
+        last = np.ceil(z1).clip(0, nz).astype(np.int64)
+        spans = np.zeros((size[0] * size[1], nz + 1), dtype=np.int8)
+        np.add.at(spans, (rays, first), 1)
+        np.add.at(spans, (rays, last), -1)
+        vox = np.cumsum(spans[:,:-1], axis=1, dtype=np.int8) > 0
+        return vox.reshape(shape).astype(np.uint8)
+
+    # Length of each interval inside voxel k, which spans [k - .5, k + .5)
+    x, y = np.divmod(rays, size[1])
+    cols = (x // nsub) * shape[1] + y // nsub
+    weight = 1. / nsub**2
+    z0, z1 = z0.clip(-.5, nz - .5), z1.clip(-.5, nz - .5)
+    first = np.floor(z0 + .5).astype(np.int64)
+    last = np.floor(z1 + .5).astype(np.int64)
+    spans = np.zeros((shape[0] * shape[1], nz + 1), dtype=np.float32)
+    ends = np.zeros((shape[0] * shape[1], nz + 1), dtype=np.float32)
+    same = first == last
+    np.add.at(ends, (cols[same], first[same]), weight * (z1 - z0)[same])
+    cols, first, last, z0, z1 = cols[~same], first[~same], last[~same], z0[~same], z1[~same]
+    np.add.at(ends, (cols, first), weight * (first + .5 - z0))
+    np.add.at(ends, (cols, last), weight * (z1 - last + .5))
+    np.add.at(spans, (cols, first + 1), weight)
+    np.add.at(spans, (cols, last), -weight)
+    vox = np.cumsum(spans, axis=1) + ends
+    return vox[:,:nz].reshape(shape)
 
 def measure_volume(pts, polys):
     from tvtk.api import tvtk
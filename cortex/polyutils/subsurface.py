@@ -1,9 +1,15 @@
 """utilities for efficiently working with patches of cortex (aka subsurfaces)"""
+import hashlib
+import threading
+
 import numpy as np
 import scipy.sparse
 
 from .misc import _memo
 
+#Guards the subsurfaces kept by create_subsurface, which may run from threads
+_subsurfaces_lock = threading.Lock()
+
 
 class SubsurfaceMixin(object):
     """mixin for Surface of efficient methods for working with subsurfaces
@@ -33,6 +39,12 @@ class SubsurfaceMixin(object):
     - [benchmarks recorded on lab desktop workstation]
     """
 
+    #number of recently created subsurfaces kept by create_subsurface, none by default
+    subsurface_cache_size = 0
+
+    #per-face properties that a subsurface takes from its parent, see _slice_operators
+    _face_properties = ("ppts", "face_normals", "face_areas", "_facenorm_cross_edge", "_cot_edge")
+
     def create_subsurface(self, vertex_mask=None, polygon_mask=None):
         """Create subsurface for efficient operations on subset of Surface
 
@@ -40,6 +52,15 @@ class SubsurfaceMixin(object):
         - input vertex_mask is not necessarily the final vertex_mask used
             - final vertex_mask is always derived from polygon_mask
             - this prevents dangling vertices
+        - only the polygons around the vertices of vertex_mask are tested, using
+          the connected matrix of the surface
+        - operators already computed on the surface are sliced into the
+          subsurface rather than recomputed (see _slice_operators)
+        - with subsurface_cache_size > 0, the last subsurface_cache_size
+          subsurfaces are kept, keyed by a hash of their polygons, and the same
+          object is returned again for the same polygons, along with its cached
+          factorizations
+            - callers opting in must not modify the returned subsurfaces
 
         Parameters
         ----------
@@ -54,33 +75,99 @@ class SubsurfaceMixin(object):
             if vertex_mask is None:
                 raise Exception('must specify vertex_mask or polygon_mask')
 
-            polygon_mask = (
-                vertex_mask[self.polys[:, 0]]
-                * vertex_mask[self.polys[:, 1]]
-                * vertex_mask[self.polys[:, 2]]
-            )
+            # only polygons touching a vertex of the mask can be in the subsurface
+            connected = self.connected
+            vertices = np.flatnonzero(vertex_mask)
+            starts, stops = connected.indptr[vertices], connected.indptr[vertices + 1]
+            touching = np.repeat(stops - np.cumsum(stops - starts), stops - starts)
+            touching = np.unique(connected.indices[touching + np.arange(len(touching))])
+            polygons = touching[vertex_mask[self.polys[touching]].all(axis=1)]
+
+        else:
+            polygons = np.flatnonzero(polygon_mask)
+
+        if self.subsurface_cache_size <= 0:
+            return self._extract_subsurface(polygons)
+
+        key = hashlib.sha1(polygons.astype(np.int64).tobytes()).hexdigest()
+        with _subsurfaces_lock:
+            subsurface = self._subsurfaces.pop(key, None)
+            if subsurface is not None:
+                self._subsurfaces[key] = subsurface
+                return subsurface
+
+        subsurface = self._extract_subsurface(polygons)
+        with _subsurfaces_lock:
+            self._subsurfaces[key] = subsurface
+            while len(self._subsurfaces) > self.subsurface_cache_size:
+                self._subsurfaces.popitem(last=False)
+
+        return subsurface
+
+    def _extract_subsurface(self, polygons):
+        """build the subsurface made of polygons, see create_subsurface"""
+        polygon_mask = np.zeros(self.polys.shape[0], dtype=bool)
+        polygon_mask[polygons] = True
 
         # select only vertices that appear in a polygon of polygon_mask
+        vertex_inverse = np.unique(self.polys[polygons]).astype(np.intp)
         vertex_mask = np.zeros(self.pts.shape[0], dtype=bool)
-        vertex_mask[self.polys[polygon_mask].flat] = True
+        vertex_mask[vertex_inverse] = True
 
         # build map from old index to new index
         # vertices not in the subsurface are represented with large numbers
-        vertex_map = np.ones(self.pts.shape[0], dtype=np.int) * np.iinfo(np.int32).max
-        vertex_map[vertex_mask] = range(vertex_mask.sum())
+        vertex_map = np.full(self.pts.shape[0], np.iinfo(np.int32).max, dtype=np.int32)
+        vertex_map[vertex_inverse] = np.arange(len(vertex_inverse), dtype=np.int32)
 
         # reindex vertices and polygons
-        subsurface_vertices = self.pts[vertex_mask, :]
-        subsurface_polygons = vertex_map[self.polys[polygon_mask, :]]
+        subsurface_vertices = self.pts[vertex_inverse, :]
+        subsurface_polygons = vertex_map[self.polys[polygons, :]].astype(np.int64)
 
         # create subsurface
         subsurface = self.__class__(pts=subsurface_vertices, polys=subsurface_polygons)
         subsurface.subsurface_vertex_mask = vertex_mask
         subsurface.subsurface_vertex_map = vertex_map
         subsurface.subsurface_polygon_mask = polygon_mask
+        subsurface._cache[self._memo_key("subsurface_vertex_inverse")] = vertex_inverse
+        self._slice_operators(subsurface, vertex_inverse, polygons)
 
         return subsurface
 
+    def _slice_operators(self, subsurface, vertices, polygons):
+        """copy the operators already computed on this surface into subsurface
+
+        - per-face properties and cotangent weights are rows of the parent's
+        - vertex-face matrices (connected, _polyconn) are submatrices of the
+          parent's, since every vertex of a subsurface polygon is in the subsurface
+        - vertex-vertex operators (adj, laplace_operator) are not sliced: the
+          parent's also count the polygons just outside the subsurface, so they
+          are assembled again from the sliced cotangent weights and face areas
+        """
+        cache = self._cache
+        sliced = {}
+        for name in self._face_properties:
+            value = cache.get(self._memo_key(name))
+            if value is not None:
+                sliced[name] = (
+                    tuple(v[polygons] for v in value) if isinstance(value, tuple)
+                    else value[polygons]
+                )
+
+        cots = cache.get(self._memo_key("cotangent_weights"))
+        if cots is not None:
+            sliced["cotangent_weights"] = cots[:, polygons]
+
+        for name in ("connected", "_polyconn"):
+            value = cache.get(self._memo_key(name))
+            if value is not None:
+                sliced[name] = (
+                    tuple(v[vertices][:, polygons] for v in value) if isinstance(value, tuple)
+                    else value[vertices][:, polygons]
+                )
+
+        for name, value in sliced.items():
+            subsurface._cache[subsurface._memo_key(name)] = value
+
     @property
     @_memo
     def subsurface_vertex_inverse(self):
@@ -446,6 +533,98 @@ class SubsurfaceMixin(object):
 
         return output
 
+    def get_geodesic_strip_patches(self, pairs, radius, include_strip_coordinates=True,
+                                   attempts=5, n_jobs=None):
+        """return strip patches for many (v0, v1) pairs, see get_geodesic_strip_patch()
+
+        - paths between all pairs are found along the mesh edges, in batches of
+          sparse Dijkstra searches (see batch_shortest_paths)
+        - the strip around each path is selected by fast marching from the whole
+          path, stopped at radius, so no subsurface is factored to select it
+            - falls back to get_geodesic_patch() if cortex.polyutils.fmm is not compiled
+        - strip coordinates are computed on each strip's subsurface, solving for
+          all path vertices at once
+        - repeated pairs are computed once, and pairs are processed in parallel
+          by a pool of n_jobs workers
+
+        Parameters
+        ----------
+        - pairs : list of (int, int)
+            indices of the start and end point of each strip
+        - radius : number
+            radius of section around geodesic path
+        - include_strip_coordinates : bool
+            whether to compute coordinates of strips
+        - attempts : int
+            number of attempts to use for working with singular subsurfaces,
+            widening the strip each time
+        - n_jobs : int
+            number of workers, defaults to the number of CPUs
+
+        Output
+        ------
+        - list of dicts, as returned by get_geodesic_strip_patch(), for each pair
+        """
+        from .. import mp
+        from .exact_geodesic import ExactGeodesicException
+
+        pairs = np.asarray(pairs, dtype=int).reshape(-1, 2)
+        unique_pairs, pair_index = np.unique(pairs, axis=0, return_inverse=True)
+
+        # all paths from the same start point come from one search
+        sources, source_index = np.unique(unique_pairs[:, 0], return_inverse=True)
+        targets = [unique_pairs[source_index == s, 1] for s in range(len(sources))]
+        source_paths = self.batch_shortest_paths(sources, targets)
+        paths = [None] * len(unique_pairs)
+        for s in range(len(sources)):
+            for path, p in zip(source_paths[s], np.nonzero(source_index == s)[0]):
+                paths[p] = path
+
+        def strip_mask(path, radius):
+            try:
+                close_enough = self.fmm_geodesic_distance(path, max_distance=radius) <= radius
+            except ExactGeodesicException:
+                return self.get_geodesic_patch(vertex=path, radius=radius)['vertex_mask']
+            return self.get_connected_vertices(vertex=np.asarray(path), mask=close_enough)
+
+        def func(p):
+            v0, v1 = unique_pairs[p]
+            working_radius = radius
+            for attempt in range(attempts):
+                vertex_mask = strip_mask(paths[p], working_radius)
+                if not include_strip_coordinates:
+                    return vertex_mask, None
+                subsurface = self.create_subsurface(vertex_mask=vertex_mask)
+                try:
+                    coordinates = subsurface.get_strip_coordinates(
+                        v0=subsurface.subsurface_vertex_map[v0],
+                        v1=subsurface.subsurface_vertex_map[v1],
+                        geodesic_path=subsurface.subsurface_vertex_map[paths[p]],
+                    )
+                except RuntimeError:
+                    # singular subsurface
+                    working_radius *= 1.1
+                    continue
+                return vertex_mask, subsurface.lift_subsurface_data(coordinates['coordinates'])
+            raise Exception('could not find suitable radius')
+
+        self._prebuild("connected")
+        strips = mp.map(func, range(len(unique_pairs)), procs=n_jobs)
+
+        outputs = []
+        for p in pair_index:
+            vertex_mask, coordinates = strips[p]
+            output = {
+                'vertex_mask': vertex_mask,
+                'geodesic_path': paths[p],
+            }
+            if include_strip_coordinates:
+                output['subsurface'] = self.create_subsurface(vertex_mask=vertex_mask)
+                output['coordinates'] = coordinates
+            outputs.append(output)
+
+        return outputs
+
     def get_strip_coordinates(self, v0, v1, geodesic_path=None, distance_algorithm='softmax'):
         """get 2D coordinates of surface from v0 to v1
 
@@ -470,7 +649,7 @@ class SubsurfaceMixin(object):
         if geodesic_path is None:
             geodesic_path = self.geodesic_path(v0, v1)
 
-        geodesic_distances = np.vstack([self.geodesic_distance([v]) for v in geodesic_path])
+        geodesic_distances = self.geodesic_distances(list(geodesic_path))
         v0_distance = geodesic_distances[0, :]
 
         bound = self.boundary_vertices
@@ -493,7 +672,7 @@ class SubsurfaceMixin(object):
             index = np.argmax(geodesic_distances[1, :][candidates])
             new_v0 = np.where(candidates)[0][index]
             new_path_0 = self.geodesic_path(new_v0, v0)[:-1]
-            new_geodesic_distances_0 = np.vstack([self.geodesic_distance([v]) for v in new_path_0])
+            new_geodesic_distances_0 = self.geodesic_distances(list(new_path_0))
 
             v0 = new_v0
             geodesic_path = np.hstack([new_path_0, geodesic_path])
@@ -514,7 +693,7 @@ class SubsurfaceMixin(object):
             index = np.argmax(geodesic_distances[1, :][candidates])
             new_v1 = np.where(candidates)[0][index]
             new_path_1 = self.geodesic_path(v1, new_v1)[1:]
-            new_geodesic_distances_1 = np.vstack([self.geodesic_distance([v]) for v in new_path_1])
+            new_geodesic_distances_1 = self.geodesic_distances(list(new_path_1))
 
             v1 = new_v1
             geodesic_path = np.hstack([geodesic_path, new_path_1])
@@ -536,8 +715,8 @@ class SubsurfaceMixin(object):
         # Calling directly self.geodesic_distance(geodesic_path) is somehow
         # not precise enough on patches, probably because we don't deal
         # correctly with boundaries in the heat method solver. Here instead,
-        # we call self.geodesic_distance on each point and take the min.
-        distance_from_line = np.min([self.geodesic_distance([ii]) for ii in geodesic_path], axis=0)
+        # we take the min of the distances to each point of the path.
+        distance_from_line = geodesic_distances.min(axis=0)
         
         # compute the sign for each side of the line
         geodesic_mask = np.zeros(self.pts.shape[0], dtype=bool)
@@ -1,5 +1,9 @@
 # -*- coding: utf-8 -*-
 
+import os
+import hashlib
+import tempfile
+import functools
 from collections import OrderedDict
 
 import numpy as np
@@ -13,6 +17,73 @@ from . import subsurface
 from .misc import _memo
 
 
+def _stored(fn):
+    """Stores the sparse matrices or arrays returned by a Surface property in the
+    surface's `cachedir`, if it has one, and loads them from there afterwards.
+    Properties may return a single matrix or a tuple of them. Only used for the
+    operators that are slow to rebuild."""
+    @functools.wraps(fn)
+    def storedfn(self):
+        if self.cachedir is None:
+            return fn(self)
+
+        fname = self._cachefile(fn.__name__.strip("_"))
+        try:
+            with np.load(fname) as npz:
+                items = [_load_item(npz, "%d_"%i) for i in range(int(npz['count']))]
+                return tuple(items) if npz['tuple'] else items[0]
+        except (IOError, KeyError, ValueError):
+            pass
+
+        value = fn(self)
+        items = value if isinstance(value, tuple) else (value,)
+        arrays = dict(count=len(items), tuple=isinstance(value, tuple))
+        for i, item in enumerate(items):
+            arrays.update(_save_item(item, "%d_"%i))
+        _savez_atomic(fname, **arrays)
+        return value
+
+    return storedfn
+
+def _savez_atomic(fname, **arrays):
+    """Saves an npz file through a temporary file, so that readers never see a
+    partially written file"""
+    fd, tmpname = tempfile.mkstemp(suffix=".npz", dir=os.path.dirname(fname))
+    with os.fdopen(fd, "wb") as fp:
+        np.savez(fp, **arrays)
+    # mkstemp files are private; give it the permissions of a plain np.savez
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmpname, 0o666 & ~umask)
+    os.rename(tmpname, fname)
+
+def _save_item(item, prefix):
+    if sparse.issparse(item):
+        item = item.tocsr()
+        return {prefix+"data":item.data, prefix+"indices":item.indices,
+                prefix+"indptr":item.indptr, prefix+"shape":item.shape}
+    return {prefix+"array":item}
+
+def _load_item(npz, prefix):
+    if prefix+"array" in npz:
+        return npz[prefix+"array"]
+    return sparse.csr_matrix((npz[prefix+"data"], npz[prefix+"indices"], npz[prefix+"indptr"]),
+                             shape=npz[prefix+"shape"])
+
+def _factor(A, order=None):
+    """LU factorization of the symmetric sparse matrix `A`, returning its solve
+    function and the fill-reducing ordering SuperLU picked. Given an `order`
+    from an earlier factorization of a matrix with the same pattern, the
+    ordering step is skipped."""
+    if order is None:
+        lu = sparse.linalg.splu(A.tocsc())
+        return lu.solve, np.argsort(lu.perm_c)
+
+    lu = sparse.linalg.splu(A[order][:,order].tocsc(), permc_spec="NATURAL",
+                            diag_pivot_thresh=0., options=dict(SymmetricMode=True))
+    inverse = np.argsort(order)
+    return lambda b: lu.solve(b[order])[inverse], order
+
 class Surface(exact_geodesic.ExactGeodesicMixin, subsurface.SubsurfaceMixin):
     """Represents a single cortical hemisphere surface. Can be the white matter surface,
     pial surface, fiducial (mid-cortical) surface, inflated surface, flattened surface,
@@ -26,14 +97,127 @@ class Surface(exact_geodesic.ExactGeodesicMixin, subsurface.SubsurfaceMixin):
         Location of each vertex in space (mm). Order is x, y, z.
     polys : 2D ndarray, shape (total_polys, 3)
         Indices of the vertices in each triangle in the surface.
+    cachedir : str, optional
+        Directory in which the operators of the surface that are slow to rebuild
+        (Laplace-Beltrami operator, geodesic neighborhoods) are stored across
+        sessions, keyed by a hash of `pts` and `polys`. By default they are only
+        kept in memory.
+    cachename : str, optional
+        Name of the surface in `cachedir`. When writing a file, those stored by
+        a surface of the same name with other points or polygons are removed.
     """
-    def __init__(self, pts, polys):
+    def __init__(self, pts, polys, cachedir=None, cachename=None):
         self.pts = pts.astype(np.double)
         self.polys = polys
+        self.cachedir = cachedir
+        self.cachename = cachename
 
         self._cache = dict()
         self._rlfac_solvers = dict()
         self._nLC_solvers = dict()
+        self._smooth_solvers = dict()
+        self._orderings = dict()
+        self._subsurfaces = OrderedDict()
+
+    #Properties that only depend on `polys`, kept by `update_pts`
+    _topology = ("connected", "adj", "_polyconn", "_laplace_pattern",
+                 "boundary_vertices", "graph")
+
+    def update_pts(self, pts):
+        """Moves the vertices of the surface to `pts`, keeping its topology.
+
+        Structures that only depend on the faces, such as the adjacency and
+        connectivity matrices and the sparsity pattern of the Laplace-Beltrami
+        operator, are kept, and `ppts` is refreshed in place. Other geometric
+        properties are recomputed when next used, and the heat method and
+        smoothing solvers are refactored reusing the fill-reducing ordering of
+        the previous factorization. Subsurfaces kept by `create_subsurface` are
+        dropped. Useful when the vertices move repeatedly, as during relaxation
+        or flattening.
+
+        The operators of the moved surface are no longer stored in `cachedir`,
+        which is reset to None, so that each step doesn't leave files behind.
+
+        Parameters
+        ----------
+        pts : 2D ndarray, shape (total_verts, 3)
+            New location of each vertex.
+        """
+        pts = np.asarray(pts, dtype=np.double)
+        if pts.shape != self.pts.shape:
+            raise ValueError("Expected points of shape %r, got %r"%(self.pts.shape, pts.shape))
+        self.pts[:] = pts
+        self.cachedir = None
+
+        keep = [self._memo_key(name) for name in self._topology]
+        cache = dict((key, self._cache[key]) for key in keep if key in self._cache)
+        ppts = self._cache.get(self._memo_key("ppts"))
+        if ppts is not None:
+            np.take(self.pts, self.polys, axis=0, out=ppts)
+            cache[self._memo_key("ppts")] = ppts
+        self._cache = cache
+        self._rlfac_solvers.clear()
+        self._nLC_solvers.clear()
+        self._smooth_solvers.clear()
+        with subsurface._subsurfaces_lock:
+            self._subsurfaces.clear()
+
+    def _prebuild(self, *names):
+        """Builds the memoized properties `names` ahead of a parallel map, so that
+        forked workers and threads share them instead of each building its own"""
+        for name in names:
+            getattr(self, name)
+
+    @classmethod
+    def _memo_key(cls, name):
+        """Key of the memoized property `name` in `_cache`"""
+        return id(getattr(cls, name).fget.__wrapped__)
+
+    def _cachefile(self, name):
+        """Path of the file storing `name` in `cachedir`. Files stored by an older
+        version of a surface with the same `cachename` are removed."""
+        prefix = "surface_" if self.cachename is None else "surface_%s_"%self.cachename
+        suffix = "_%s.npz"%name
+        if self.cachename is not None and os.path.isdir(self.cachedir):
+            for fname in os.listdir(self.cachedir):
+                key = fname[len(prefix):-len(suffix)]
+                if (fname.startswith(prefix) and fname.endswith(suffix) and key != self._hash
+                        and len(key) == 16 and all(c in "0123456789abcdef" for c in key)):
+                    try:
+                        os.unlink(os.path.join(self.cachedir, fname))
+                    except OSError:
+                        pass
+        return os.path.join(self.cachedir, prefix + self._hash + suffix)
+
+    @classmethod
+    def from_db(cls, subject, surf="fiducial", hemi="lh", cache=False):
+        """Loads a surface of `subject` from the database. With `cache`, its
+        Laplace-Beltrami operator and geodesic neighborhoods are stored in the
+        subject's cache directory, so that later sessions don't rebuild them.
+
+        Parameters
+        ----------
+        subject : str
+            Name of the subject
+        surf : str, optional
+            Type of surface, e.g. fiducial, inflated or flat
+        hemi : str, optional
+            Hemisphere, 'lh' or 'rh'
+        cache : bool, optional
+            Store the operators in the subject's cache directory. Default False.
+        """
+        from ..database import db
+        pts, polys = db.get_surf(subject, surf, hemi)
+        cachedir = db.get_cache(subject) if cache else None
+        return cls(pts, polys, cachedir=cachedir, cachename="%s_%s"%(surf, hemi))
+
+    @property
+    @_memo
+    def _hash(self):
+        """Content hash of the surface, keying its stored operators"""
+        sha = hashlib.sha1(np.ascontiguousarray(self.pts).tobytes())
+        sha.update(np.ascontiguousarray(self.polys, dtype=np.int64).tobytes())
+        return sha.hexdigest()[:16]
 
     @property
     @_memo
@@ -127,6 +311,7 @@ class Surface(exact_geodesic.ExactGeodesicMixin, subsurface.SubsurfaceMixin):
 
     @property
     @_memo
+    @_stored
     def laplace_operator(self):
         """Laplace-Beltrami operator for this surface. A sparse adjacency matrix with
         edge weights determined by the cotangents of the angles opposite each edge.
@@ -146,12 +331,13 @@ class Surface(exact_geodesic.ExactGeodesicMixin, subsurface.SubsurfaceMixin):
 
         ## Stiffness matrix
         npt = len(self.pts)
-        cots1, cots2, cots3 = self.cotangent_weights
+        indptr, indices, index = self._laplace_pattern
+        def offdiag(weights):
+            data = np.bincount(index, np.tile(weights, 2), minlength=len(indices))
+            return sparse.csr_matrix((data, indices, indptr), (npt, npt))
+
         # W is weighted adjacency matrix
-        W1 = sparse.coo_matrix((cots1, (self.polys[:,1], self.polys[:,2])), (npt, npt))
-        W2 = sparse.coo_matrix((cots2, (self.polys[:,2], self.polys[:,0])), (npt, npt))
-        W3 = sparse.coo_matrix((cots3, (self.polys[:,0], self.polys[:,1])), (npt, npt))
-        W = (W1 + W1.T + W2 + W2.T + W3 + W3.T).tocsr() / 2.0
+        W = offdiag(np.hstack(self.cotangent_weights)) / 2.0
         
         # V is sum of each col
         V = sparse.dia_matrix((np.array(W.sum(0)).ravel(),[0]), (npt,npt))
@@ -160,14 +346,26 @@ class Surface(exact_geodesic.ExactGeodesicMixin, subsurface.SubsurfaceMixin):
         #A = W - V # negative operator -- more useful in practice
 
         # For FEM:
-        Be1 = sparse.coo_matrix((self.face_areas, (self.polys[:,1], self.polys[:,2])), (npt, npt))
-        Be2 = sparse.coo_matrix((self.face_areas, (self.polys[:,2], self.polys[:,0])), (npt, npt))
-        Be3 = sparse.coo_matrix((self.face_areas, (self.polys[:,0], self.polys[:,1])), (npt, npt))
         Bd = self.connected.dot(self.face_areas) / 6
         dBd = scipy.sparse.dia_matrix((Bd,[0]), (len(D),len(D)))
-        B = (Be1 + Be1.T + Be2 + Be2.T + Be3 + Be3.T)/12 + dBd
+        B = offdiag(np.tile(self.face_areas, 3)) / 12 + dBd
         return B, D, W, V
 
+    @property
+    @_memo
+    def _laplace_pattern(self):
+        """Sparsity pattern of the off-diagonal entries of the Laplace-Beltrami
+        operator, as CSR (indptr, indices), and the entry of each half-edge,
+        for edges (1,2), (2,0) and (0,1) of every face and then their reverse"""
+        npt = len(self.pts)
+        p1, p2, p3 = self.polys.T.astype(np.int64)
+        rows = np.hstack([p2, p3, p1, p3, p1, p2])
+        cols = np.hstack([p3, p1, p2, p2, p3, p1])
+        edges, index = np.unique(rows * npt + cols, return_inverse=True)
+        indptr = np.zeros(npt + 1, dtype=np.int64)
+        np.cumsum(np.bincount(edges // npt, minlength=npt), out=indptr[1:])
+        return indptr, edges % npt, index
+
     def mean_curvature(self):
         """Compute mean curvature of this surface using the Laplace-Beltrami operator.
         Curvature is computed at each vertex. It's probably pretty noisy, and should
@@ -189,43 +387,63 @@ class Surface(exact_geodesic.ExactGeodesicMixin, subsurface.SubsurfaceMixin):
         curv = (L.dot(self.pts) * self.vertex_normals).sum(1)
         return curv
 
-    def smooth(self, scalars, factor=1.0, iterations=1):
+    def smooth(self, scalars, factor=1.0, iterations=1, dtype=np.float64):
         """Smooth vertex-wise function given by `scalars` across the surface using
         mean curvature flow method (see http://brickisland.net/cs177fa12/?p=302).
 
-        Amount of smoothing is controlled by `factor`.
+        Amount of smoothing is controlled by `factor`. The factorization of the
+        smoothing matrix is cached for each `factor`, and several functions
+        passed as the columns of a 2D `scalars` are smoothed in one solve.
 
         Parameters
         ----------
-        scalars : 1D ndarray, shape (total_verts,)
+        scalars : ndarray, shape (total_verts,) or (total_verts, K)
             A scalar-valued function across the cortex, such as the curvature
-            supplied by mean_curvature.
+            supplied by mean_curvature, or K such functions.
         factor : float, optional
             Amount of smoothing to perform, larger values smooth more.
         iterations : int, optional
             Number of times to repeat smoothing, larger values smooths more.
+        dtype : dtype, optional
+            Precision of the factorization and of the result. np.float32 halves
+            the memory used for long blocks of functions, such as time series.
 
         Returns
         -------
-        smscalars : 1D ndarray, shape (total_verts,)
+        smscalars : ndarray, same shape as `scalars`
             Smoothed scalar values.
         """
         if factor == 0.0:
             return scalars
-        
-        B,D,W,V = self.laplace_operator
-        npt = len(D)
-        lfac = sparse.dia_matrix((D,[0]), (npt,npt)) - factor * (W-V)
-        goodrows = np.nonzero(~np.array(lfac.sum(0) == 0).ravel())[0]
-        lfac_solver = sparse.linalg.dsolve.factorized(lfac[goodrows][:,goodrows])
-        to_smooth = scalars.copy()
+
+        dtype = np.dtype(dtype)
+        goodrows, lfac_solver = self._smooth_solver(factor, dtype)
+        D = self.laplace_operator[1].astype(dtype)
+        if scalars.ndim > 1:
+            D = D[:,np.newaxis]
+        to_smooth = scalars.astype(dtype)
         for _ in range(iterations):
             from_smooth = lfac_solver((D * to_smooth)[goodrows])
             to_smooth[goodrows] = from_smooth
-        smscalars = np.zeros(scalars.shape)
+        smscalars = np.zeros(scalars.shape, dtype=dtype)
         smscalars[goodrows] = from_smooth
         return smscalars
-        
+
+    def _smooth_solver(self, factor, dtype):
+        """Factors the mean curvature flow matrix of `smooth`, once per factor
+        and precision"""
+        key = factor, dtype.str
+        if key not in self._smooth_solvers:
+            B, D, W, V = self.laplace_operator
+            npt = len(D)
+            lfac = sparse.dia_matrix((D,[0]), (npt,npt)) - factor * (W-V)
+            goodrows = np.nonzero(~np.array(lfac.sum(0) == 0).ravel())[0]
+            lfac = lfac.tocsr()[goodrows][:,goodrows].astype(dtype)
+            order = self._orderings.get(("smooth", len(goodrows)))
+            solver, self._orderings["smooth", len(goodrows)] = _factor(lfac, order)
+            self._smooth_solvers[key] = goodrows, solver
+        return self._smooth_solvers[key]
+
     @property
     @_memo
     def avg_edge_length(self):
@@ -504,22 +722,7 @@ class Surface(exact_geodesic.ExactGeodesicMixin, subsurface.SubsurfaceMixin):
             vertex in `verts`.
         """
         npt = len(self.pts)
-        if m not in self._rlfac_solvers or m not in self._nLC_solvers:
-            B, D, W, V = self.laplace_operator
-            nLC = W - V # negative laplace matrix
-            if not fem:
-                spD = sparse.dia_matrix((D,[0]), (npt,npt)).tocsr() # lumped mass matrix
-            else:
-                spD = B
-            
-            t = m * self.avg_edge_length ** 2 # time of heat evolution
-            lfac = spD - t * nLC # backward Euler matrix
-
-            # Exclude rows with zero weight (these break the sparse LU)
-            goodrows = np.nonzero(~np.array(lfac.sum(0) == 0).ravel())[0]
-            self._goodrows = goodrows
-            self._rlfac_solvers[m] = sparse.linalg.dsolve.factorized(lfac[goodrows][:,goodrows])
-            self._nLC_solvers[m] = sparse.linalg.dsolve.factorized(nLC[goodrows][:,goodrows])
+        self._geodesic_solvers(m, fem)
 
         # I. "Integrate the heat flow ̇u = ∆u for some fixed time t"
         # ---------------------------------------------------------
@@ -566,6 +769,123 @@ class Surface(exact_geodesic.ExactGeodesicMixin, subsurface.SubsurfaceMixin):
 
         return phi
 
+    def _geodesic_solvers(self, m, fem):
+        """Factors the backward Euler and Laplace matrices of the heat method for
+        step length `m`, once per `m`."""
+        npt = len(self.pts)
+        if m not in self._rlfac_solvers or m not in self._nLC_solvers:
+            B, D, W, V = self.laplace_operator
+            nLC = W - V # negative laplace matrix
+            if not fem:
+                spD = sparse.dia_matrix((D,[0]), (npt,npt)).tocsr() # lumped mass matrix
+            else:
+                spD = B
+            
+            t = m * self.avg_edge_length ** 2 # time of heat evolution
+            lfac = spD - t * nLC # backward Euler matrix
+
+            # Exclude rows with zero weight (these break the sparse LU)
+            goodrows = np.nonzero(~np.array(lfac.sum(0) == 0).ravel())[0]
+            if not np.array_equal(goodrows, getattr(self, "_goodrows", None)):
+                self._orderings.clear()
+            self._goodrows = goodrows
+            self._rlfac_solvers[m], self._orderings["rlfac"] = _factor(
+                lfac[goodrows][:,goodrows], self._orderings.get("rlfac"))
+            self._nLC_solvers[m], self._orderings["nLC"] = _factor(
+                nLC[goodrows][:,goodrows], self._orderings.get("nLC"))
+        return self._rlfac_solvers[m], self._nLC_solvers[m]
+
+    def geodesic_distances(self, sources, m=1.0, fem=False, dtype=np.float64,
+                           filename=None, chunksize=32):
+        """Geodesic distance (in mm) from each of several sets of vertices, with
+        the heat method of `geodesic_distance`.
+
+        Each set of sources gives one row of distances, as `geodesic_distance`
+        would. The rows are computed `chunksize` at a time: the heat flow and the
+        Poisson equation are solved for all of the chunk's sets at once through
+        the cached factorizations, and the gradient and divergence are taken for
+        all of them in a few array operations.
+
+        Parameters
+        ----------
+        sources : list of int or list of lists of int
+            Sets of vertices to compute distance from. A plain list of vertices
+            gives the distance from each vertex on its own.
+        m : float, optional
+            Reverse Euler step length, see `geodesic_distance`. Default 1.0.
+        fem : bool, optional
+            Use the Finite Element Method mass matrix, see `geodesic_distance`.
+        dtype : dtype, optional
+            Data type of the returned distances, e.g. np.float32 to halve the
+            memory taken by many rows. Default float64.
+        filename : str, optional
+            If given, the distances are written to a .npy file of that name,
+            and returned as a memory map of it.
+        chunksize : int, optional
+            Number of source sets solved at once. Memory use grows with it by
+            about 10 floats per face per set.
+
+        Returns
+        -------
+        dists : 2D ndarray, shape (len(sources), total_verts)
+            Geodesic distance (in mm) from each vertex in the surface to the
+            closest vertex of each set of sources.
+        """
+        sources = [np.atleast_1d(verts) for verts in sources]
+        npt = len(self.pts)
+        shape = len(sources), npt
+        if filename is not None:
+            dists = np.lib.format.open_memmap(filename, mode="w+", dtype=dtype, shape=shape)
+        else:
+            dists = np.zeros(shape, dtype=dtype)
+
+        rlfac_solver, nLC_solver = self._geodesic_solvers(m, fem)
+        goodrows = self._goodrows
+        fe12, fe23, fe31 = self._facenorm_cross_edge
+        c32, c13, c21 = self._cot_edge
+        conn1, conn2, conn3 = self._polyconn
+        p1, p2, p3 = self.polys.T
+        # Degenerate faces have no gradient
+        with np.errstate(divide="ignore"):
+            ifa2 = 1. / (2 * self.face_areas[:,np.newaxis,np.newaxis])
+        ifa2[np.isinf(ifa2)] = 0
+
+        for start in range(0, len(sources), chunksize):
+            chunk = sources[start:start+chunksize]
+            cols = np.repeat(np.arange(len(chunk)), [len(verts) for verts in chunk])
+
+            # I. Integrate the heat flow, one column per set of sources
+            u0 = np.zeros((npt, len(chunk)))
+            u0[np.hstack(chunk), cols] = 1.0
+            u = np.zeros((npt, len(chunk)))
+            u[goodrows] = rlfac_solver(u0[goodrows])
+
+            # II. Normalized gradient at each face, shape (faces, 3, sets)
+            X = fe12[:,:,np.newaxis] * u[p3][:,np.newaxis]
+            X += fe23[:,:,np.newaxis] * u[p1][:,np.newaxis]
+            X += fe31[:,:,np.newaxis] * u[p2][:,np.newaxis]
+            X *= ifa2
+            norm = np.sqrt(np.einsum("fck,fck->fk", X, X))
+            with np.errstate(divide="ignore"):
+                norm = -1. / norm
+            norm[np.isinf(norm)] = 0
+            X *= norm[:,np.newaxis]
+
+            # III. Solve the Poisson equation for the integrated divergence of X
+            divx = (conn1.dot(0.5 * np.einsum("fc,fck->fk", c32, X)) +
+                    conn2.dot(0.5 * np.einsum("fc,fck->fk", c13, X)) +
+                    conn3.dot(0.5 * np.einsum("fc,fck->fk", c21, X)))
+            del X
+            goodphi = nLC_solver(divx[goodrows])
+            phi = np.zeros((npt, len(chunk)))
+            phi[goodrows] = goodphi - goodphi.min(0)
+            phi[np.hstack(chunk), cols] = 0.0
+            dists[start:start+len(chunk)] = phi.T
+
+        if filename is not None:
+            dists.flush()
+        return dists
+
     def geodesic_path(self, a, b, max_len=1000, d=None, **kwargs):
         """Finds the shortest path between two points `a` and `b`.
 
@@ -606,13 +926,216 @@ class Surface(exact_geodesic.ExactGeodesicMixin, subsurface.SubsurfaceMixin):
         path = [a]
         if d is None:
             d = self.geodesic_distance([b], **kwargs)
+        adj = self.adj
         while path[-1] != b:
-            n = np.array([v for v in self.graph.neighbors(path[-1])])
+            n = adj.indices[adj.indptr[path[-1]]:adj.indptr[path[-1]+1]]
             path.append(n[d[n].argmin()])
             if len(path) > max_len:
                 return path
         return path
 
+    def shortest_paths(self, source, targets):
+        """Finds the shortest paths along the mesh edges from `source` to each of
+        `targets`, with Dijkstra's algorithm on `distance_graph`.
+
+        The search is bounded to paths a little longer than the euclidean
+        distance to the farthest target, and runs on the vertices whose summed
+        euclidean distances to the source and to a target fit within that
+        bound, since no shorter path can leave them. The bound is widened until
+        every target is reached, so paths between nearby vertices only explore
+        their neighborhood.
+
+        Parameters
+        ----------
+        source : int
+            Vertex that is the start of the paths
+        targets : list of int
+            Vertices that are the ends of the paths
+
+        Returns
+        -------
+        paths : list of lists
+            List of the vertices in the path from `source` to each target
+        """
+        from scipy.sparse import csgraph
+        targets = np.asarray(targets, dtype=int)
+        if len(targets) == 0:
+            return []
+
+        tree = self._kdtree
+        euclid = np.sqrt(((self.pts[targets] - self.pts[source])**2).sum(1)).max()
+        limit = 1.25 * euclid + 2 * self.avg_edge_length
+        while True:
+            if limit > np.sqrt(((tree.maxes - tree.mins)**2).sum()):
+                limit = np.inf
+            local = np.sort(tree.query_ball_point(self.pts[source], limit))
+            if np.isfinite(limit):
+                lpts = self.pts[local]
+                dsource = np.sqrt(((lpts - self.pts[source])**2).sum(1))
+                dtarget = distance.cdist(lpts, self.pts[targets]).min(1)
+                local = local[dsource + dtarget <= limit]
+            # Positions of the source and targets among the local vertices
+            lsource, ltargets = np.searchsorted(local, [source]), np.searchsorted(local, targets)
+            found = ltargets < len(local)
+            found[found] = local[ltargets[found]] == targets[found]
+            if found.all():
+                dist, pred = csgraph.dijkstra(self._local_graph(local), indices=lsource[0],
+                                              return_predecessors=True, limit=limit)
+                if np.isfinite(dist[ltargets]).all():
+                    break
+            if np.isinf(limit):
+                raise ValueError("No path from vertex %d to all of the vertices %s"%(source, targets))
+            limit *= 2
+
+        return [_trace_path(pred, lsource[0], target, local) for target in ltargets]
+
+    def batch_shortest_paths(self, sources, targets, chunksize=256):
+        """Finds the shortest paths along the mesh edges from each of `sources` to
+        its own list of `targets`, like `shortest_paths`.
+
+        The sources are searched `chunksize` at a time in a single Dijkstra call,
+        on the vertices within the search bound of any source in the chunk. This
+        amortizes the setup of the search over many short paths, such as the
+        paths between the vertices sharing a voxel. Sources whose targets are not
+        within their bound are searched again with `shortest_paths`.
+
+        Parameters
+        ----------
+        sources : list of int
+            Vertices that are the start of the paths
+        targets : list of lists of int
+            Vertices that are the ends of the paths, for each source
+
+        Returns
+        -------
+        paths : list of lists of lists
+            For each source, the list of the vertices in the path to each target
+        """
+        from scipy.sparse import csgraph
+        tree = self._kdtree
+        paths = []
+        for start in range(0, len(sources), chunksize):
+            csources = np.asarray(sources[start:start+chunksize], dtype=int)
+            ctargets = [np.asarray(t, dtype=int) for t in targets[start:start+chunksize]]
+            euclid = np.array([np.sqrt(((self.pts[t] - self.pts[s])**2).sum(1)).max() if len(t) > 0 else 0
+                               for s, t in zip(csources, ctargets)])
+            limits = 1.25 * euclid + 2 * self.avg_edge_length
+            balls = tree.query_ball_point(self.pts[csources], limits)
+            local = np.unique(np.hstack([np.asarray(ball, dtype=int) for ball in balls]))
+            lsources = np.searchsorted(local, csources)
+            dist, pred = csgraph.dijkstra(self._local_graph(local), indices=lsources,
+                                          return_predecessors=True, limit=limits.max())
+
+            for k, (source, ctarget) in enumerate(zip(csources, ctargets)):
+                # Paths within the bound of this source lie in its own ball
+                ltargets = np.searchsorted(local, ctarget)
+                if (dist[k, ltargets] <= limits[k]).all():
+                    paths.append([_trace_path(pred[k], lsources[k], t, local) for t in ltargets])
+                else:
+                    paths.append(self.shortest_paths(source, ctarget))
+        return paths
+
+    def geodesic_neighborhoods(self, radius, seeds=None, n_jobs=None, chunksize=64, method="dijkstra"):
+        """Distances from each seed to the vertices within `radius` of it, along
+        the mesh edges or across the faces, as a sparse matrix.
+
+        The seeds are processed `chunksize` at a time, each chunk in a single
+        Dijkstra search bounded by `radius` on the vertices within `radius` (in
+        euclidean distance) of its seeds. The chunks run in parallel through
+        `cortex.mp`. For surfaces with a `cachedir`, the result is stored there
+        and reused for the same radius and seeds.
+
+        Distances along the mesh edges slightly overestimate the geodesic
+        distance across the faces, so the neighborhoods are slightly smaller
+        than those of `get_geodesic_patch`. With method='fmm', each seed is
+        instead searched by fast marching across the faces, which overestimates
+        much less (see `cortex.polyutils.fmm`).
+
+        Parameters
+        ----------
+        radius : float
+            Radius of the neighborhoods, in mm
+        seeds : list of int, optional
+            Centers of the neighborhoods. Defaults to every vertex.
+        n_jobs : int, optional
+            Number of workers. Defaults to the number of CPUs.
+        chunksize : int, optional
+            Number of seeds searched at once.
+        method : str, optional
+            'dijkstra' (default) for distances along the edges, or 'fmm'.
+
+        Returns
+        -------
+        neighborhoods : sparse matrix, shape (len(seeds), total_verts)
+            CSR matrix holding the distance from each seed (row) to each vertex
+            of its neighborhood. The seed itself is stored as an explicit zero.
+        """
+        from scipy.sparse import csgraph
+        from .. import mp
+        if method not in ("dijkstra", "fmm"):
+            raise ValueError("Unknown method %r"%method)
+        seeds = np.arange(len(self.pts)) if seeds is None else np.asarray(seeds, dtype=int)
+
+        fname = None
+        if self.cachedir is not None:
+            seedhash = hashlib.sha1(seeds.astype(np.int64).tobytes()).hexdigest()[:8]
+            tag = "" if method == "dijkstra" else "_" + method
+            fname = self._cachefile("neighborhoods_%g_%s%s"%(radius, seedhash, tag))
+            try:
+                with np.load(fname) as npz:
+                    return _load_item(npz, "")
+            except (IOError, KeyError, ValueError):
+                pass
+
+        tree = self._kdtree
+        graph = self.distance_graph if method == "dijkstra" else None
+        def func(start):
+            cseeds = seeds[start:start+chunksize]
+            balls = tree.query_ball_point(self.pts[cseeds], radius)
+            local = np.unique(np.hstack([np.asarray(ball, dtype=int) for ball in balls] + [cseeds]))
+            dist = csgraph.dijkstra(self._local_graph(local, graph), indices=np.searchsorted(local, cseeds),
+                                    limit=radius)
+            rows, cols = np.nonzero(dist <= radius)
+            return rows + start, local[cols], dist[rows, cols]
+
+        if method == "fmm":
+            from . import fmm
+            vertex_faces = self.connected.indptr, self.connected.indices
+            def func(start):
+                indptr, cols, dists = fmm.geodesic_neighborhoods(
+                    self.pts, self.polys, seeds[start:start+chunksize], radius, vertex_faces)
+                return np.repeat(np.arange(start, start+len(indptr)-1), np.diff(indptr)), cols, dists
+
+        chunks = mp.map(func, range(0, len(seeds), chunksize), procs=n_jobs)
+        rows, cols, dists = [np.hstack(x) for x in zip(*chunks)] if len(chunks) > 0 else ([], [], [])
+        neighborhoods = sparse.csr_matrix((dists, (rows, cols)), shape=(len(seeds), len(self.pts)))
+
+        if fname is not None:
+            _savez_atomic(fname, **_save_item(neighborhoods, ""))
+        return neighborhoods
+
+    def shortest_path(self, a, b):
+        """Finds the shortest path along the mesh edges between vertices `a` and
+        `b`. See `shortest_paths`.
+
+        Returns
+        -------
+        path : list
+            List of the vertices in the path from a to b
+        """
+        return self.shortest_paths(a, [b])[0]
+
+    def _local_graph(self, local, graph=None):
+        """`distance_graph` (or `graph`) restricted to the sorted vertices `local`,
+        dropping the edges leaving them"""
+        if graph is None:
+            graph = self.distance_graph
+        rows = graph[local]
+        cols = np.searchsorted(local, rows.indices).clip(max=len(local)-1)
+        keep = local[cols] == rows.indices
+        ridx = np.repeat(np.arange(len(local)), np.diff(rows.indptr))
+        return sparse.csr_matrix((rows.data[keep], (ridx[keep], cols[keep])), (len(local),)*2)
+
     @property
     @_memo
     def _cot_edge(self):
@@ -703,11 +1226,14 @@ class Surface(exact_geodesic.ExactGeodesicMixin, subsurface.SubsurfaceMixin):
     @property
     @_memo
     def graph(self):
-        """NetworkX undirected graph representing this Surface.
+        """NetworkX undirected graph representing this Surface. Only needed to
+        export the mesh to NetworkX; paths are computed on `adj` and
+        `distance_graph`.
         """
         import networkx as nx
+        rows, cols = sparse.triu(self.adj).nonzero()
         graph = nx.Graph()
-        graph.add_edges_from(self.iter_surfedges)
+        graph.add_edges_from(zip(rows.tolist(), cols.tolist()))
         return graph
 
     def get_graph(self):
@@ -734,12 +1260,32 @@ class Surface(exact_geodesic.ExactGeodesicMixin, subsurface.SubsurfaceMixin):
 
         return distances
 
+    @property
+    @_memo
+    def distance_graph(self):
+        """Sparse vertex adjacency matrix (CSR) holding the length of each edge,
+        for use with `scipy.sparse.csgraph`.
+        """
+        adj = self.adj
+        rows = np.repeat(np.arange(adj.shape[0]), np.diff(adj.indptr))
+        lengths = np.sqrt(((self.pts[rows] - self.pts[adj.indices])**2).sum(1))
+        return sparse.csr_matrix((lengths, adj.indices, adj.indptr), adj.shape)
+
+    @property
+    @_memo
+    def _kdtree(self):
+        from scipy.spatial import cKDTree
+        return cKDTree(self.pts)
+
     @property
     @_memo
     def weighted_distance_graph(self):
+        """NetworkX export of `distance_graph`, with edge lengths as weights.
+        """
         import networkx as nx
+        graph = sparse.triu(self.distance_graph).tocoo()
         weighted_graph = nx.Graph()
-        weighted_graph.add_weighted_edges_from(self.iter_surfedges_weighted)
+        weighted_graph.add_weighted_edges_from(zip(graph.row.tolist(), graph.col.tolist(), graph.data.tolist()))
         return weighted_graph
 
     def extract_chunk(self, nfaces=100, seed=None, auxpts=None):
@@ -880,6 +1426,14 @@ class Surface(exact_geodesic.ExactGeodesicMixin, subsurface.SubsurfaceMixin):
         face2 = self.connected[p2]
 
 
+def _trace_path(pred, source, target, local):
+    """Follows the Dijkstra predecessors `pred` back from `target` to `source`,
+    returning the path in the vertex numbering given by `local`"""
+    path = [target]
+    while path[-1] != source:
+        path.append(pred[path[-1]])
+    return local[path[::-1]].tolist()
+
 class _ptset(object):
     def __init__(self):
         self.idx = OrderedDict()
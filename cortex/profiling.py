@@ -0,0 +1,118 @@
+"""Timers and counters for long-running pycortex jobs.
+
+Hot paths such as `cortex.mp.map`, the mapper and flatmap caches and surface
+reads report events here. Events are dictionaries with at least a `name` and a
+`time`; they are delivered to every registered sink, and are dropped when no
+sink is registered. Counters are always accumulated in `counters`.
+
+Example
+-------
+>>> from cortex import profiling
+>>> profiling.add_sink(profiling.JSONLinesSink("/tmp/cortex_profile.jsonl"))
+>>> with profiling.timer("my_job") as t:
+...     t.items += 10
+"""
+import time
+import json
+import logging
+import threading
+from collections import defaultdict
+
+logger = logging.getLogger("cortex.profiling")
+
+_sinks = []
+_lock = threading.Lock()
+
+#Totals of every counter reported through `count`
+counters = defaultdict(int)
+
+class LogSink(object):
+    """Sink writing events to a logger, by default the cortex.profiling one"""
+    def __init__(self, logger=logger, level=logging.INFO):
+        self.logger = logger
+        self.level = level
+
+    def __call__(self, event):
+        fields = " ".join("%s=%s"%(k, v) for k, v in sorted(event.items()) if k not in ("name", "time"))
+        self.logger.log(self.level, "%s %s", event['name'], fields)
+
+class JSONLinesSink(object):
+    """Sink appending events to a file as one JSON object per line"""
+    def __init__(self, filename):
+        self.filename = filename
+
+    def __call__(self, event):
+        line = json.dumps(event, default=str)
+        with _lock, open(self.filename, "a") as fp:
+            fp.write(line + "\n")
+
+def add_sink(sink):
+    """Registers a sink, a callable receiving each event dictionary. Returns the
+    sink so that it can later be passed to `remove_sink`."""
+    _sinks.append(sink)
+    return sink
+
+def remove_sink(sink):
+    _sinks.remove(sink)
+
+def enabled():
+    return len(_sinks) > 0
+
+def emit(name, **fields):
+    """Sends an event to all sinks"""
+    if len(_sinks) == 0:
+        return
+    fields.update(name=name, time=time.time())
+    for sink in list(_sinks):
+        try:
+            sink(fields)
+        except Exception:
+            logger.exception("Profiling sink %r failed", sink)
+
+def count(name, n=1, **fields):
+    """Increments the counter `name` by `n` and reports it"""
+    with _lock:
+        counters[name] += n
+    emit(name, count=n, **fields)
+
+def reset():
+    """Clears all counters"""
+    with _lock:
+        counters.clear()
+
+class Timer(object):
+    """Timing of a block of work, see `timer`. Set or increment `items` and
+    `bytes` inside the block to report throughput."""
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        self.items = 0
+        self.bytes = 0
+        self.elapsed = None
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.elapsed = time.time() - self._start
+        fields = dict(self.fields, elapsed=self.elapsed)
+        if self.items:
+            fields.update(items=self.items, items_per_sec=self.items / max(self.elapsed, 1e-9))
+        if self.bytes:
+            fields.update(bytes=self.bytes)
+        if exc_type is not None:
+            fields.update(error=exc_type.__name__)
+        emit(self.name, **fields)
+
+def timer(name, **fields):
+    """Context manager timing a block and reporting it as the event `name`,
+    along with the extra `fields`.
+
+    Returns
+    -------
+    timer : Timer
+        Exposes `items` and `bytes` for throughput, and `elapsed` once the
+        block has finished.
+    """
+    return Timer(name, fields)
@@ -9,6 +9,7 @@ import string
 
 from .. import utils
 from .. import dataset
+from .. import profiling
 from ..database import db
 from ..options import config
 
@@ -139,16 +140,22 @@ def get_flatcache(subject, xfmname, pixelwise=True, thick=32, sampler='nearest',
 
     if not os.path.exists(cachefile) or recache:
         print("Generating a flatmap cache")
-        if pixelwise and xfmname is not None:
-            pixmap = _make_pixel_cache(subject, xfmname, height=height, sampler=sampler, thick=thick, depth=depth)
-        else:
-            pixmap = _make_vertex_cache(subject, height=height)
-        np.savez(cachefile, data=pixmap.data, indices=pixmap.indices, indptr=pixmap.indptr, shape=pixmap.shape)
+        profiling.count("flatcache.miss", subject=subject, cachefile=cachefile)
+        with profiling.timer("flatcache.build", subject=subject, cachefile=cachefile) as timer:
+            if pixelwise and xfmname is not None:
+                pixmap = _make_pixel_cache(subject, xfmname, height=height, sampler=sampler, thick=thick, depth=depth)
+            else:
+                pixmap = _make_vertex_cache(subject, height=height)
+            np.savez(cachefile, data=pixmap.data, indices=pixmap.indices, indptr=pixmap.indptr, shape=pixmap.shape)
+            timer.items = pixmap.shape[0]
     else:
         from scipy import sparse
-        npz = np.load(cachefile)
-        pixmap = sparse.csr_matrix((npz['data'], npz['indices'], npz['indptr']), shape=npz['shape'])
-        npz.close()
+        profiling.count("flatcache.hit", subject=subject, cachefile=cachefile)
+        with profiling.timer("flatcache.load", subject=subject, cachefile=cachefile) as timer:
+            npz = np.load(cachefile)
+            pixmap = sparse.csr_matrix((npz['data'], npz['indices'], npz['indptr']), shape=npz['shape'])
+            npz.close()
+            timer.bytes = os.path.getsize(cachefile)
 
     if not pixelwise and xfmname is not None:
         from scipy import sparse
@@ -311,21 +318,16 @@ def _make_hatch_image(hatch_data, height, sampler='nearest', hatch_space=4, reca
 
 def _make_flatmask(subject, height=1024):
     from .. import polyutils
-    from PIL import Image, ImageDraw
     pts, polys = db.get_surf(subject, "flat", merge=True, nudge=True)
-    left, right = polyutils.trace_poly(polyutils.boundary_edges(polys))
+    edges = polyutils.boundary_edges(polys)
 
     aspect = (height / (pts.max(0) - pts.min(0))[1])
-    lpts = (pts[left] - pts.min(0)) * aspect
-    rpts = (pts[right] - pts.min(0)) * aspect
-
-    im = Image.new('L', (int(aspect * (pts.max(0) - pts.min(0))[0]), height))
-    draw = ImageDraw.Draw(im)
-    draw.polygon(lpts[:,:2].ravel().tolist(), fill=255)
-    draw.polygon(rpts[:,:2].ravel().tolist(), fill=255)
+    ppts = (pts - pts.min(0)) * aspect
+    shape = height, int(aspect * (pts.max(0) - pts.min(0))[0])
+    mask = polyutils.scanline_rasterize(ppts, edges, shape)
     extents = np.hstack([pts.min(0), pts.max(0)])[[0,3,1,4]]
 
-    return np.array(im).T > 0, extents
+    return mask.T, extents
 
 def _make_vertex_cache(subject, height=1024):
     from scipy import sparse
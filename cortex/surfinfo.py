@@ -31,8 +31,8 @@ def curvature(outfile, subject, smooth=20):
         Amount of smoothing to apply to the curvature map. Default 20.
     """
     curvs = []
-    for pts, polys in db.get_surf(subject, "fiducial"):
-        surf = polyutils.Surface(pts, polys)
+    for hem in ["lh", "rh"]:
+        surf = polyutils.Surface.from_db(subject, "fiducial", hem)
         curv = surf.smooth(surf.mean_curvature(), smooth)
         curvs.append(curv)
     np.savez(outfile, left=curvs[0], right=curvs[1])
@@ -65,9 +65,9 @@ def distortion(outfile, subject, dist_type='areal', smooth=20):
     """
     distortions = []
     for hem in ["lh", "rh"]:
-        fidvert, fidtri = db.get_surf(subject, "fiducial", hem)
+        surf = polyutils.Surface.from_db(subject, "fiducial", hem)
+        fidvert, fidtri = surf.pts, surf.polys
         flatvert, flattri = db.get_surf(subject, "flat", hem)
-        surf = polyutils.Surface(fidvert, fidtri)
 
         dist = getattr(polyutils.Distortion(flatvert, fidvert, flattri), dist_type)
         smdist = surf.smooth(dist, smooth)
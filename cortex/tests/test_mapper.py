@@ -0,0 +1,226 @@
+import numpy as np
+from scipy import sparse
+
+from cortex.mapper import Mapper
+
+shape = (4, 5, 6)
+
+def _random_mapper(nleft=20, nright=30, seed=0):
+    rng = np.random.RandomState(seed)
+    nvox = np.prod(shape)
+    left = sparse.random(nleft, nvox, density=.1, format='csr', random_state=rng)
+    right = sparse.random(nright, nvox, density=.1, format='csr', random_state=rng)
+    return Mapper(left, right, shape, "S1", "fullhead")
+
+def _isolated_cache(tmp_path, monkeypatch):
+    """Points the subject caches at `tmp_path`, so that the tests build their own
+    mappers instead of rewriting those of the filestore"""
+    from cortex.database import db
+    monkeypatch.setattr(db, "get_cache", lambda subject: str(tmp_path))
+
+def test_map_timeseries():
+    mapper = _random_mapper()
+    movie = np.random.randn(10, *shape)
+    expected = np.hstack([(m * movie.reshape(10, -1).T).T for m in mapper.masks])
+
+    assert np.allclose(mapper.map_timeseries(movie, chunk_frames=3), expected)
+
+    out = np.zeros((10, mapper.nverts))
+    mapper.map_timeseries(iter(movie), chunk_frames=4, out=out)
+    assert np.allclose(out, expected)
+
+    mask = np.random.rand(*shape) > .5
+    masked = mapper.map_timeseries(movie[:, mask], mask=mask)
+    movie[:, ~mask] = 0
+    assert np.allclose(masked, mapper.map_timeseries(movie))
+
+    for frames in (movie, iter(movie), movie[:, mask][:, :-1]):
+        try:
+            mapper.map_timeseries(frames, mask=mask)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("frames not matching the mask were accepted")
+
+def test_line_getmask():
+    from cortex.mapper import line, samplers
+    rng = np.random.RandomState(1)
+    wm = rng.rand(50, 3) * np.array(shape[::-1])
+    pia = wm + rng.rand(50, 3)
+    polys = np.arange(48).reshape(-1, 3)
+
+    expected = sparse.csr_matrix((50, np.prod(shape)))
+    for t in np.linspace(0, 1, 10)[1:-1]:
+        i, j, data = samplers.trilinear(pia*t + wm*(1-t), shape)
+        expected = expected + sparse.csr_matrix((data / 8, (i, j)), shape=expected.shape)
+
+    for chunk in (None, 3):
+        mask = line.LineTrilin._getmask(pia, wm, polys, shape, npts=8, chunk=chunk)
+        assert np.allclose(mask.toarray(), expected.toarray())
+
+def test_mapper_cache():
+    import os
+    import tempfile
+    from cortex.mapper import _savecache
+    mapper = _random_mapper()
+    cachedir = os.path.join(tempfile.mkdtemp(), "fullhead_mapper")
+    _savecache(cachedir, mapper.masks[0], mapper.masks[1], mapper.shape)
+
+    umask = os.umask(0o022)
+    try:
+        _savecache(cachedir, mapper.masks[0], mapper.masks[1], mapper.shape)
+    finally:
+        os.umask(umask)
+    # replacing the cache keeps it readable by others, as np.savez did
+    assert os.stat(cachedir).st_mode & 0o777 == 0o755
+    assert os.stat(os.path.join(cachedir, "shape.npy")).st_mode & 0o777 == 0o644
+
+    cached = Mapper.from_cache(cachedir, "S1", "fullhead")
+    assert cached.shape == shape
+    assert not cached.masks[0].data.flags.writeable
+    for orig, new in zip(mapper.masks, cached.masks):
+        assert (orig != new).nnz == 0
+
+def test_build_mappers(tmp_path, monkeypatch):
+    from cortex.mapper import build_mappers, get_mapper
+    _isolated_cache(tmp_path, monkeypatch)
+    mappers, timings = build_mappers("S1", "fullhead", types=["nearest", "line_nearest"],
+                                     n_jobs=2, recache=True)
+    assert set(timings) == set(["nearest", "line_nearest"])
+    for type, mapper in mappers.items():
+        cached = get_mapper("S1", "fullhead", type)
+        for orig, new in zip(mapper.masks, cached.masks):
+            assert (orig != new).nnz == 0
+
+def test_lanczos():
+    from cortex.mapper import samplers
+    window = 2
+    kernel = lambda x: np.where(np.abs(x) < window, np.sinc(x) * np.sinc(x / window), 0)
+    coords = np.random.rand(40, 3) * np.array(shape[::-1])
+    coords[3] = np.nan
+    coords[4] = np.round(coords[4])
+    i, j, data = samplers.lanczos(coords, shape, window=window, chunksize=16, mp=False)
+    mask = sparse.csr_matrix((data, (i, j)), shape=(len(coords), np.prod(shape))).toarray()
+
+    z, y, x = np.mgrid[:shape[0], :shape[1], :shape[2]]
+    for v, (cx, cy, cz) in enumerate(coords):
+        expected = (kernel(cx - x) * kernel(cy - y) * kernel(cz - z)).ravel()
+        if v != 3:
+            expected /= expected.sum()
+        assert np.allclose(mask[v], np.nan_to_num(expected))
+
+def test_collapse():
+    from cortex.mapper import samplers
+    j = np.random.randint(0, 20, 200)
+    data = np.random.rand(200)
+    uniques, sums = samplers.collapse(j, data)
+    assert np.array_equal(uniques, np.unique(j))
+    assert np.allclose(sums, [data[j == u].sum() for u in uniques])
+
+    rows = [(j[:50], data[:50]), None, (j[50:], data[50:])]
+    mat = samplers.sparse_rows(rows, (3, 20)).toarray()
+    assert np.allclose(mat[0], np.bincount(j[:50], data[:50], minlength=20))
+    assert np.allclose(mat[1], 0)
+    assert np.allclose(mat[2], np.bincount(j[50:], data[50:], minlength=20))
+
+def test_backwards_block():
+    mapper = _random_mapper()
+    verts = np.random.randn(mapper.nverts, 3)
+    block = mapper.backwards(verts)
+    assert block.shape == (3,) + shape
+    for k in range(3):
+        assert np.allclose(block[k], mapper.backwards(verts[:, k]))
+
+def test_backward_operator():
+    import os
+    import tempfile
+    from cortex.mapper import _savecache
+    mapper = _random_mapper()
+    cachedir = os.path.join(tempfile.mkdtemp(), "fullhead_mapper")
+    _savecache(cachedir, mapper.masks[0], mapper.masks[1], mapper.shape)
+    mapper = Mapper.from_cache(cachedir, "S1", "fullhead")
+    umask = os.umask(0o022)
+    try:
+        operator = mapper.backward_operator()
+    finally:
+        os.umask(umask)
+    opfile = os.path.join(cachedir, "backward_operator.npz")
+    assert os.stat(opfile).st_mode & 0o777 == 0o644
+    assert operator.shape == (np.prod(shape), mapper.nverts)
+    rowsums = np.array(operator.sum(1)).ravel()
+    touched = np.array(mapper.stacked().sum(0)).ravel() > 0
+    assert np.allclose(rowsums[touched], 1)
+    assert np.allclose(rowsums[~touched], 0)
+
+    verts = np.random.randn(mapper.nverts, 2)
+    vols = mapper.backwards(verts, method='operator')
+    assert np.allclose(vols.reshape(2, -1), operator.dot(verts).T)
+
+def test_stacked_masks():
+    mapper = _random_mapper()
+    rng = np.random.RandomState(1)
+    masks = [rng.rand(*shape) > .5 for _ in range(mapper.stacked_cache_size + 2)]
+    for mask in masks:
+        cols = mapper.stacked(mask)
+        assert np.allclose(cols.toarray(), mapper.stacked().toarray()[:, mask.ravel()])
+    assert len(mapper._masked) == mapper.stacked_cache_size
+    assert mapper.stacked(masks[-1]) is cols
+
+def test_project_file(tmp_path, monkeypatch):
+    import os
+    import h5py
+    import nibabel
+    from cortex import dataset
+    from cortex.mapper import get_mapper, project_file
+    _isolated_cache(tmp_path, monkeypatch)
+    mapper = get_mapper("S1", "fullhead", type="nearest")
+    rng = np.random.RandomState(0)
+    movie = rng.randn(7, *mapper.shape).astype(np.float32)
+
+    path = str(tmp_path / "movie.nii")
+    nibabel.save(nibabel.Nifti1Image(movie.T, np.eye(4)), path)
+    out_path = str(tmp_path / "movie.hdf")
+    assert project_file("S1", "fullhead", path, out_path, chunk=3) == (7, mapper.nverts)
+
+    expected = mapper(dataset.Volume(movie, "S1", "fullhead")).data
+    with h5py.File(out_path, "r") as h5:
+        assert np.allclose(h5["data"][:], expected, atol=1e-5)
+
+    # masked HDF5 input is appended to the same output
+    mask = rng.rand(*mapper.shape) > .5
+    with h5py.File(str(tmp_path / "masked.hdf"), "w") as h5:
+        h5["movie"] = movie[:, mask]
+    shape = project_file("S1", "fullhead", str(tmp_path / "masked.hdf"), out_path,
+                         chunk=4, in_name="movie", mask=mask)
+    assert shape == (14, mapper.nverts)
+    with h5py.File(out_path, "r") as h5:
+        assert np.allclose(h5["data"][7:], mapper.stacked().dot((movie * mask).reshape(7, -1).T).T,
+                           atol=1e-5)
+
+    # a single volume is one frame, even with more slices than the chunk size
+    path = str(tmp_path / "volume.nii")
+    nibabel.save(nibabel.Nifti1Image(movie[0].T, np.eye(4)), path)
+    out_path = str(tmp_path / "volume.hdf")
+    assert project_file("S1", "fullhead", path, out_path, chunk=8) == (1, mapper.nverts)
+    volume = nibabel.load(path).get_fdata().T
+    expected = mapper(dataset.Volume(volume, "S1", "fullhead")).data
+    with h5py.File(out_path, "r") as h5:
+        assert np.allclose(h5["data"][0], expected, atol=1e-5)
+
+def test_multimapper(tmp_path, monkeypatch):
+    import os
+    from cortex import dataset
+    from cortex.mapper import MultiMapper, get_mapper
+    _isolated_cache(tmp_path, monkeypatch)
+    xfmnames = ["fullhead", "retinotopy"]
+    multi = MultiMapper("S1", xfmnames, type="nearest", recache=True)
+    rng = np.random.RandomState(0)
+    volumes = [rng.randn(*mapper.shape) for mapper in multi.mappers]
+    mapped = multi(volumes)
+    for xfmname, mapper, volume, vertex in zip(xfmnames, multi.mappers, volumes, mapped):
+        single = get_mapper("S1", xfmname, type="nearest", recache=True)
+        assert mapper.shape == single.shape
+        for batched, built in zip(mapper.masks, single.masks):
+            assert (batched != built).nnz == 0
+        assert np.allclose(vertex.data, single(dataset.Volume(volume, "S1", xfmname)).data)
+    assert sorted(os.listdir(str(tmp_path))) == ["fullhead_pointnn", "retinotopy_pointnn"]
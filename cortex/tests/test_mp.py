@@ -0,0 +1,85 @@
+import numpy as np
+
+from cortex import mp
+
+def _scale(x, weights):
+    return weights[x] * 2
+
+def test_map_closure():
+    offset = 10
+    results = mp.map(lambda x: x + offset, range(100), procs=2, chunksize=7)
+    assert results == [x + 10 for x in range(100)]
+
+def test_imap_shared_spawn():
+    weights = np.random.rand(50)
+    with mp.Executor(2, context="spawn", backend="process") as executor:
+        for _ in range(2):
+            results = executor.imap(_scale, range(50), shared=dict(weights=weights))
+            assert np.allclose(list(results), weights * 2)
+
+def test_imap_generator():
+    items = (x for x in range(20))
+    results = mp.imap(lambda x, weights: weights[x], items, procs=2, shared=dict(weights=np.arange(20)))
+    assert list(results) == list(range(20))
+
+def test_imap_executor_backend():
+    calls = []
+    with mp.Executor(2, backend="process") as executor:
+        results = mp.imap(lambda x: calls.append(x) or x, range(10), executor=executor, backend="inline")
+        assert list(results) == list(range(10))
+    # Only an inline run appends to this process' list
+    assert calls == list(range(10))
+
+def test_imap_spawn_closure():
+    import warnings
+    offset = 10
+    with mp.Executor(2, context="spawn", backend="process") as executor:
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            results = executor.map(lambda x: x + offset, range(20))
+    assert results == [x + 10 for x in range(20)]
+    assert any(issubclass(w.category, RuntimeWarning) for w in caught)
+
+def test_imap_without_shared_memory(monkeypatch):
+    monkeypatch.setattr(mp, "shared_memory", None)
+    weights = np.random.rand(50)
+    results = mp.map(lambda x, weights: weights[x], range(50), procs=2,
+                     shared=dict(weights=weights), backend="process")
+    assert np.allclose(results, weights)
+
+def test_select_backend():
+    with mp.Executor(4) as executor:
+        assert executor.select_backend([1]) == "inline"
+        assert executor.select_backend(range(10)) == "thread"
+        assert executor.select_backend(range(100000)) == "process"
+        assert executor.select_backend(iter(range(10))) == "process"
+        assert executor.select_backend(range(10), "process") == "process"
+    assert mp.Executor(1).select_backend(range(100000)) == "inline"
+
+    weights = np.random.rand(20)
+    for backend in ("inline", "thread", "process"):
+        results = mp.map(_scale, range(20), procs=2, shared=dict(weights=weights), backend=backend)
+        assert np.allclose(results, weights * 2)
+
+def test_shared_tracker():
+    # Workers attaching the shared blocks must leave the parent's resource
+    # tracker registrations alone, or unlinking them prints tracker errors
+    import sys
+    import subprocess
+    code = "\n".join([
+        "import numpy as np",
+        "from cortex import mp",
+        "from cortex.tests.test_mp import _scale",
+        "w = np.arange(1000.)",
+        "for _ in range(3):",
+        "    out = mp.map(lambda x, weights: weights[x], range(1000), procs=2,",
+        "                 shared=dict(weights=w), backend='process')",
+        "    assert out == list(w)",
+        "with mp.Executor(2, context='spawn', backend='process') as executor:",
+        "    for _ in range(3):",
+        "        assert executor.map(_scale, range(100), shared=dict(weights=w)) == list(2 * w[:100])",
+    ])
+    proc = subprocess.run([sys.executable, "-W", "ignore", "-c", code],
+                          stderr=subprocess.PIPE, universal_newlines=True)
+    assert proc.returncode == 0, proc.stderr
+    assert "Traceback" not in proc.stderr and "leaked" not in proc.stderr, proc.stderr
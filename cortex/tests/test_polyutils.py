@@ -16,3 +16,283 @@ def test_surfpatch():
     subwm, subpia, subpolys = surf.extract_chunk(auxpts=pia)
     subsurf = polyutils.Surface(subwm, subpolys)
     return [patch for patch in subsurf.patches(n=0.5)]
+
+def _grid_surface(n=8):
+    y, x = np.mgrid[:n, :n]
+    pts = np.vstack([x.ravel(), y.ravel(), np.zeros(n*n)]).T.astype(float)
+    idx = np.arange(n*n).reshape(n, n)
+    a, b, c, d = idx[:-1,:-1].ravel(), idx[:-1,1:].ravel(), idx[1:,:-1].ravel(), idx[1:,1:].ravel()
+    polys = np.vstack([np.array([a, b, d]).T, np.array([a, d, c]).T])
+    return polyutils.Surface(pts, polys)
+
+def test_shortest_paths():
+    surf = _grid_surface()
+    graph = surf.distance_graph
+    assert graph.nnz == surf.adj.nnz
+    assert np.allclose(graph.data[graph.data > 1], np.sqrt(2))
+
+    # the diagonal of the grid is a straight chain of edges
+    assert surf.shortest_path(0, 63) == list(range(0, 64, 9))
+    paths = surf.shortest_paths(7, [0, 56])
+    assert paths[0] == list(range(7, -1, -1))
+    # the anti-diagonal has no edges, so the path is a staircase of unit steps
+    steps = np.diff(surf.pts[paths[1]], axis=0)
+    assert paths[1][-1] == 56 and len(steps) == 14
+    assert np.allclose(np.abs(steps).sum(1), 1)
+
+    batch = surf.batch_shortest_paths([0, 7, 20], [[63], [0, 56], []], chunksize=2)
+    assert batch[0] == [surf.shortest_path(0, 63)]
+    assert [len(path) for path in batch[1]] == [8, 15]
+    assert batch[2] == []
+
+    graph = surf.weighted_distance_graph
+    assert graph.number_of_edges() == surf.graph.number_of_edges() == surf.adj.nnz // 2
+
+def test_stored_operators():
+    import os
+    import tempfile
+    cachedir = tempfile.mkdtemp()
+    grid = _grid_surface()
+    surf = polyutils.Surface(grid.pts, grid.polys, cachedir=cachedir)
+    expected = surf.laplace_operator
+    assert "surface_%s_laplace_operator.npz"%surf._hash in os.listdir(cachedir)
+
+    stored = polyutils.Surface(grid.pts, grid.polys, cachedir=cachedir).laplace_operator
+    B, D, W, V = expected
+    assert np.allclose(stored[1], D)
+    for orig, new in zip([B, W, V], [stored[0], stored[2], stored[3]]):
+        assert abs(orig - new).max() < 1e-12
+
+    moved = polyutils.Surface(grid.pts + 1e-3, grid.polys, cachedir=cachedir)
+    assert moved._hash != surf._hash
+
+    # only the slow operators are stored, and a named surface replaces its own
+    # older files but not those of other surfaces
+    cachedir = tempfile.mkdtemp()
+    for pts in (grid.pts, grid.pts + 1e-3):
+        for name in ("grid_lh", "grid_rh"):
+            named = polyutils.Surface(pts, grid.polys, cachedir=cachedir, cachename=name)
+            named.adj, named.connected, named.laplace_operator
+    assert sorted(os.listdir(cachedir)) == sorted(
+        "surface_%s_%s_laplace_operator.npz"%(name, named._hash) for name in ("grid_lh", "grid_rh"))
+
+def test_geodesic_distances():
+    import os
+    import tempfile
+    surf = _grid_surface(12)
+    sources = [[0], [5, 100], [143]]
+    dists = surf.geodesic_distances(sources, chunksize=2)
+    assert dists.shape == (3, 144)
+    for verts, dist in zip(sources, dists):
+        assert np.allclose(dist, surf.geodesic_distance(verts))
+
+    filename = os.path.join(tempfile.mkdtemp(), "dists.npy")
+    stored = surf.geodesic_distances(sources, dtype=np.float32, filename=filename)
+    assert stored.dtype == np.float32
+    assert np.allclose(np.load(filename), dists, atol=1e-4)
+
+def test_geodesic_neighborhoods():
+    import os
+    import tempfile
+    from scipy.sparse import csgraph
+    grid = _grid_surface(12)
+    surf = polyutils.Surface(grid.pts, grid.polys, cachedir=tempfile.mkdtemp())
+    seeds = [0, 30, 77]
+    hoods = surf.geodesic_neighborhoods(3.5, seeds=seeds, n_jobs=1, chunksize=2)
+    full = csgraph.dijkstra(surf.distance_graph, indices=seeds)
+    assert hoods.shape == (3, 144)
+    for row, dist in zip(hoods, full):
+        assert np.array_equal(row.indices, np.nonzero(dist <= 3.5)[0])
+        assert np.allclose(row.data, dist[row.indices])
+
+    assert len([f for f in os.listdir(surf.cachedir) if "neighborhoods" in f]) == 1
+    cached = surf.geodesic_neighborhoods(3.5, seeds=seeds)
+    assert abs(cached - hoods).max() == 0
+
+def test_fmm_geodesic():
+    from scipy.sparse import csgraph
+    surf = _grid_surface(12)
+    euclid = np.sqrt(((surf.pts - surf.pts[11])**2).sum(1))
+    dist = surf.fmm_geodesic_distance(11)
+    edges = csgraph.dijkstra(surf.distance_graph, indices=11)
+    assert dist[11] == 0
+    assert np.all(dist >= euclid - 1e-9) and np.all(dist <= edges + 1e-9)
+    assert np.abs(dist - euclid).mean() < .1 * np.abs(edges - euclid).mean()
+
+    both = surf.fmm_geodesic_distance([11, 132])
+    assert np.allclose(both, np.minimum(dist, surf.fmm_geodesic_distance(132)))
+
+    near = surf.fmm_geodesic_distance(11, max_distance=4)
+    assert np.array_equal(np.isinf(near), dist > 4)
+    assert np.allclose(near[dist <= 4], dist[dist <= 4])
+
+    # the exact distance stays with VTP rather than falling back to fast marching
+    from cortex.options import config
+    from cortex.polyutils.exact_geodesic import ExactGeodesicException
+    if not config.has_option('geodesic', 'vtp_path'):
+        try:
+            surf.exact_geodesic_distance(11)
+        except ExactGeodesicException:
+            pass
+        else:
+            raise AssertionError("exact_geodesic_distance ran without VTP")
+
+    hoods = surf.geodesic_neighborhoods(4, seeds=[11, 60], n_jobs=1, method="fmm")
+    assert np.array_equal(hoods[0].indices, np.nonzero(dist <= 4)[0])
+    assert np.allclose(hoods[0].data, dist[hoods[0].indices])
+
+def test_update_pts():
+    surf = _grid_surface(10)
+    adj, ppts = surf.adj, surf.ppts
+    before = surf.geodesic_distance([0])
+    moved = surf.pts.copy()
+    moved[:, 2] = np.sin(moved[:, 0] / 3.)
+    surf.update_pts(moved)
+
+    fresh = polyutils.Surface(moved, surf.polys)
+    assert surf.adj is adj and surf.ppts is ppts
+    assert np.allclose(surf.ppts, fresh.ppts)
+    assert np.allclose(surf.face_areas, fresh.face_areas)
+    for new, ref in zip(surf.laplace_operator, fresh.laplace_operator):
+        assert abs(new - ref).max() < 1e-12
+    dist = surf.geodesic_distance([0])
+    assert not np.allclose(dist, before)
+    assert np.allclose(dist, fresh.geodesic_distance([0]))
+
+    # moving a stored surface doesn't store the operators of every step
+    import os
+    import tempfile
+    cachedir = tempfile.mkdtemp()
+    stored = polyutils.Surface(moved, surf.polys, cachedir=cachedir, cachename="grid")
+    stored.laplace_operator
+    files = os.listdir(cachedir)
+    for step in range(5):
+        stored.update_pts(moved * (1 + .1 * step))
+        stored.laplace_operator, stored.geodesic_neighborhoods(2, seeds=[0], n_jobs=1)
+    assert os.listdir(cachedir) == files
+
+def test_smooth_block():
+    surf = _grid_surface(10)
+    block = np.random.RandomState(0).randn(100, 3)
+    smoothed = surf.smooth(block, factor=2., iterations=2)
+    assert smoothed.shape == block.shape
+    assert len(surf._smooth_solvers) == 1
+    for k in range(3):
+        assert np.allclose(smoothed[:, k], surf.smooth(block[:, k], factor=2., iterations=2))
+    assert len(surf._smooth_solvers) == 1
+    assert smoothed.std(0).max() < block.std(0).min()
+
+    single = surf.smooth(block, factor=2., iterations=2, dtype=np.float32)
+    assert single.dtype == np.float32
+    assert np.allclose(single, smoothed, atol=1e-5)
+
+def test_distortion_metric():
+    surf = _grid_surface(6)
+    flat = surf.pts * [2., 1., 1.]
+    dist = polyutils.Distortion(flat, surf.pts, surf.polys)
+    adj = surf.adj
+    expected = []
+    for v in range(len(surf.pts)):
+        neighbors = adj.indices[adj.indptr[v]:adj.indptr[v+1]]
+        expected.append((np.sqrt(((flat[neighbors] - flat[v])**2).sum(1)) -
+                         np.sqrt(((surf.pts[neighbors] - surf.pts[v])**2).sum(1))).mean())
+    assert np.allclose(dist.metric, expected)
+
+    # each face has a unit x edge, a unit y edge and a diagonal
+    assert np.allclose(dist.face_metric, (1 + np.sqrt(5) - np.sqrt(2)) / 3)
+
+def test_boundary_loops():
+    surf = _grid_surface(6)
+    # cut a hole out of the middle square of the grid
+    centers = surf.pts[surf.polys].mean(1)
+    hole = (np.abs(centers[:,:2] - 2.5) < .5).all(1)
+    polys = surf.polys[~hole]
+
+    edges = polyutils.boundary_edges(polys)
+    assert len(edges) == 20 + 4
+    outer, inner = polyutils.boundary_loops(polys)
+    assert len(outer) == 20 and len(inner) == 4
+    assert set(inner) == set([14, 15, 20, 21])
+    for loop in (outer, inner):
+        steps = np.abs(np.diff(surf.pts[np.append(loop, loop[0])], axis=0)).sum(1)
+        assert np.allclose(steps, 1)
+
+    # 10 pixels per unit: a 50x50 square with a 10x10 hole
+    mask = polyutils.scanline_rasterize(surf.pts * 10, edges, (60, 60))
+    assert mask.sum() == 50 * 50 - 10 * 10
+    assert not mask[25, 25] and mask[5, 5] and not mask[55, 5]
+    coverage = polyutils.scanline_rasterize(surf.pts * 10 + .25, edges, (60, 60), supersample=4)
+    assert np.isclose(coverage.sum(), 50 * 50 - 10 * 10)
+    assert np.isclose(coverage[0, 0], .5625)
+
+def test_voxelize():
+    from scipy.spatial import ConvexHull, Delaunay
+    # rays through the edges and corners of the cube must be counted once
+    pts, polys = polyutils.make_cube((3, 3, 3), 4)
+    vox = polyutils.voxelize(pts, polys, shape=(8, 8, 8), center=(0, 0, 0), mp=False)
+    assert vox.sum() == 64
+    assert np.array_equal(np.argwhere(vox).min(0), [1, 1, 1])
+
+    rng = np.random.RandomState(0)
+    pts = rng.randint(2, 14, size=(20, 3)).astype(float)
+    hull = ConvexHull(pts)
+    vox = polyutils.voxelize(pts, hull.simplices, shape=(16, 16, 16), center=(0, 0, 0), mp=False)
+    grid = np.indices((16, 16, 16)).reshape(3, -1).T
+    inside = Delaunay(pts).find_simplex(grid) >= 0
+    assert not np.any(vox.ravel() & ~inside)
+    assert vox.sum() > .9 * inside.sum()
+
+    frac = polyutils.voxelize(pts + .3, hull.simplices, shape=(16, 16, 16), center=(0, 0, 0),
+                              mp=False, partial=True)
+    assert frac.min() >= 0 and frac.max() <= 1 + 1e-6
+    assert abs(frac.sum() - hull.volume) < .01 * hull.volume
+
+def test_geodesic_strip_patches():
+    surf = _grid_surface(12)
+    pairs = [(3*12 + 2, 3*12 + 9), (8*12 + 3, 2*12 + 8), (3*12 + 2, 3*12 + 9)]
+    strips = surf.get_geodesic_strip_patches(pairs, radius=2, n_jobs=1)
+    assert len(strips) == 3
+
+    for (v0, v1), strip in zip(pairs, strips):
+        path = strip['geodesic_path']
+        assert path[0] == v0 and path[-1] == v1
+        assert strip['vertex_mask'][path].all()
+        assert strip['coordinates'].shape == (2, len(surf.pts))
+
+    # a straight path along a row of the grid
+    row = strips[0]
+    assert list(row['geodesic_path']) == list(range(3*12 + 2, 3*12 + 10))
+    inside = row['vertex_mask']
+    assert np.abs(surf.pts[inside, 1] - 3).max() <= 2
+    assert np.array_equal(row['vertex_mask'], strips[2]['vertex_mask'])
+    assert np.allclose(row['coordinates'], strips[2]['coordinates'])
+
+    masks = surf.get_geodesic_strip_patches(pairs[:2], radius=2, include_strip_coordinates=False)
+    assert 'coordinates' not in masks[0]
+    assert np.array_equal(masks[0]['vertex_mask'], row['vertex_mask'])
+
+def test_subsurface_slicing():
+    surf = _grid_surface(10)
+    surf.laplace_operator, surf.face_normals
+    mask = np.hypot(surf.pts[:,0] - 4, surf.pts[:,1] - 4) < 3
+    sub = surf.create_subsurface(vertex_mask=mask)
+    assert sub.subsurface_vertex_map.dtype == np.int32
+    assert np.array_equal(sub.subsurface_polygon_mask, mask[surf.polys].all(1))
+    assert np.array_equal(sub.pts, surf.pts[sub.subsurface_vertex_mask])
+
+    # operators sliced from the surface match those of a new surface
+    fresh = polyutils.Surface(sub.pts, sub.polys)
+    assert np.allclose(sub.face_normals, fresh.face_normals)
+    assert (sub.connected != fresh.connected).nnz == 0
+    for sliced, built in zip(sub.laplace_operator, fresh.laplace_operator):
+        if hasattr(built, "toarray"):
+            sliced, built = sliced.toarray(), built.toarray()
+        assert np.allclose(sliced, built)
+
+    # recent subsurfaces are only reused when asked for, until the surface moves
+    assert surf.create_subsurface(vertex_mask=mask) is not sub
+    surf.subsurface_cache_size = 2
+    sub = surf.create_subsurface(vertex_mask=mask)
+    assert surf.create_subsurface(polygon_mask=sub.subsurface_polygon_mask) is sub
+    surf.update_pts(surf.pts)
+    assert surf.create_subsurface(vertex_mask=mask) is not sub
@@ -0,0 +1,21 @@
+import json
+
+from cortex import mp
+from cortex import profiling
+
+def test_profiling_sinks(tmp_path):
+    events = []
+    sink = profiling.add_sink(events.append)
+    jsonfile = str(tmp_path / "events.jsonl")
+    jsonsink = profiling.add_sink(profiling.JSONLinesSink(jsonfile))
+    try:
+        mp.map(lambda x: x, range(8), procs=2)
+        profiling.count("test.hit", 2)
+    finally:
+        profiling.remove_sink(sink)
+        profiling.remove_sink(jsonsink)
+
+    assert events[0]['name'] == "mp.map" and events[0]['items'] == 8
+    assert events[1]['count'] == 2 and profiling.counters["test.hit"] >= 2
+    with open(jsonfile) as fp:
+        assert [json.loads(line)['name'] for line in fp] == ["mp.map", "test.hit"]
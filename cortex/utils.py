@@ -577,6 +577,12 @@ def get_roi_masks(subject, xfmname, roi_list=None, gm_sampler='cortical', split_
         vox_dst, vox_idx = get_vox_dist(subject, xfmname)
     if use_mapper:
         mapper = get_mapper(subject, xfmname, type=mapper_dict[gm_sampler])
+        # Back-project all the ROIs in a single block solve
+        mapped_rois = [roi for roi in roi_list if roi in roi_verts]
+        if len(mapped_rois) > 0:
+            roi_block = np.array([roi_verts[roi] for roi in mapped_rois], dtype=float).T
+            backmapped = dict(zip(mapped_rois, mapper.backwards(roi_block)))
+        vert_in_scan_all = np.hstack([np.array((m>0).sum(1)).flatten() for m in mapper.masks])
     elif use_cortex_mask:
         if isinstance(gm_sampler, string_types):
             cortex_mask = db.get_mask(subject, xfmname, type=gm_sampler)
@@ -589,13 +595,12 @@ def get_roi_masks(subject, xfmname, roi_list=None, gm_sampler='cortical', split_
                 print("ROI {} not found...".format(roi))
             continue
         if use_mapper:
-            roi_voxels[roi] = mapper.backwards(roi_verts[roi].astype(np.float))
+            roi_voxels[roi] = backmapped[roi]
             # Optionally threshold probablistic values returned by mapper
             if threshold is not None:
                 roi_voxels[roi] = roi_voxels[roi] > threshold
             # Check for partial / empty rois:
-            vert_in_scan = np.hstack([np.array((m>0).sum(1)).flatten() for m in mapper.masks])
-            vert_in_scan = vert_in_scan[roi_verts[roi]]
+            vert_in_scan = vert_in_scan_all[roi_verts[roi]]
         elif use_cortex_mask:
             vox_in_roi = np.in1d(vox_idx.flatten(), roi_verts[roi]).reshape(vox_idx.shape)
             roi_voxels[roi] = vox_in_roi & cortex_mask
@@ -758,27 +763,6 @@ def vertex_to_voxel(subject):  # Am I deprecated in favor of mappers??? Maybe?
     return all_verts
 
 
-def _set_edge_distance_graph_attribute(graph, pts, polys):
-    '''
-    adds the attribute 'edge distance' to a graph
-    '''
-    import networkx as nx
-
-    l2_distance = lambda v1, v2: np.linalg.norm(pts[v1] - pts[v2])
-    heuristic = l2_distance # A* heuristic
-
-    if not nx.get_edge_attributes(graph, 'distance'): # Add edge distances as an attribute to this graph if it isn't there
-        edge_distances = dict()
-        for x,y,z in polys:
-            edge_distances[(x,y)] = heuristic(x,y)
-            edge_distances[(y,x)] = heuristic(y,x)
-            edge_distances[(y,z)] = heuristic(y,z)
-            edge_distances[(z,y)] = heuristic(z,y)
-            edge_distances[(x,z)] = heuristic(x,z)
-            edge_distances[(z,x)] = heuristic(z,x)
-        nx.set_edge_attributes(graph, edge_distances, name='distance')
-
-
 def get_shared_voxels(subject, xfmname, hemi="both", merge=True, use_astar=True):
     '''Return voxels that are shared by multiple vertices, and for each such voxel,
        also returns the mutually farthest pair of vertices mapping to the voxel
@@ -793,8 +777,9 @@ def get_shared_voxels(subject, xfmname, hemi="both", merge=True, use_astar=True)
     merge : bool, optinal
         Join the hemispheres, if requesting both
     use_astar: bool, optional
-        Toggle to decide whether to use A* seach or geodesic paths for the
-        shortest paths
+        Toggle to decide whether to use shortest paths along the mesh edges
+        (Dijkstra search on the sparse edge graph, formerly A* search) or
+        geodesic paths
 
     Returns
     -------
@@ -804,7 +789,6 @@ def get_shared_voxels(subject, xfmname, hemi="both", merge=True, use_astar=True)
     '''
 
     from scipy.sparse import find as sparse_find
-    import networkx as nx
     Lmask, Rmask = get_mapper(subject, xfmname).masks  # Get masks for left and right hemisphere 
     if hemi == 'both':
         hemispheres = ['lh', 'rh']
@@ -820,35 +804,33 @@ def get_shared_voxels(subject, xfmname, hemi="both", merge=True, use_astar=True)
         all_voxels = mask.tolil().transpose().rows  # Map from voxels to verts
         vert_to_vox_map = dict(zip(*(sparse_find(mask)[:2])))  # From verts to vox
 
-        pts_fid, polys_fid = db.get_surf(subject, 'fiducial', hem)  # Get the fiducial surface
-        surf = Surface(pts_fid, polys_fid) #Get the fiducial surface
-        graph = surf.graph 
-
-        _set_edge_distance_graph_attribute(graph, pts_fid, polys_fid)
+        surf = Surface.from_db(subject, 'fiducial', hem) #Get the fiducial surface
 
-        l2_distance = lambda v1, v2: np.linalg.norm(pts_fid[v1] - pts_fid[v2])
-        heuristic = l2_distance  # A* heuristic
-
-        if use_astar:
-            shortest_path = lambda a, b: nx.astar_path(graph, a, b, heuristic=heuristic, weight='distance') # Find approximate shortest paths using A* search
-        else:
-            shortest_path = surf.geodesic_path  # Find shortest paths using geodesic distances
-
-        vox_vert_list = []
+        # Pairs of valid vertices sharing a voxel, grouped by their first vertex
+        groups = []
         for vox_idx, vox in enumerate(all_voxels):
             if len(vox) > 1:  # If the voxel maps to multiple vertices
                 vox = np.array(vox).astype(int)
                 for v1 in range(vox.size-1):
                     vert1 = vox[v1]
                     if vert1 in vert_to_vox_map:  # If the vertex is a valid vertex
-                        for v2 in range(v1+1, vox.size):
-                            vert2 = vox[v2]
-                            if vert2 in vert_to_vox_map:  # If the vertex is a valid vertex
-                                path = shortest_path(vert1, vert2)
-                                # Test whether any vertex in path goes out of the voxel
-                                stays_in_voxel = all([(v in vert_to_vox_map) and (vert_to_vox_map[v] == vox_idx) for v in path]) 
-                                if not stays_in_voxel:
-                                    vox_vert_list.append([vox_idx, vert1, vert2])
+                        targets = [vert2 for vert2 in vox[v1+1:] if vert2 in vert_to_vox_map]
+                        groups.append((vox_idx, vert1, targets))
+
+        if use_astar:
+            # Find shortest paths along the mesh edges, many sources at once
+            paths = surf.batch_shortest_paths([g[1] for g in groups], [g[2] for g in groups])
+        else:
+            # Find shortest paths using geodesic distances
+            paths = [[surf.geodesic_path(vert1, vert2) for vert2 in targets] for _, vert1, targets in groups]
+
+        vox_vert_list = []
+        for (vox_idx, vert1, targets), gpaths in zip(groups, paths):
+            for vert2, path in zip(targets, gpaths):
+                # Test whether any vertex in path goes out of the voxel
+                stays_in_voxel = all([(v in vert_to_vox_map) and (vert_to_vox_map[v] == vox_idx) for v in path]) 
+                if not stays_in_voxel:
+                    vox_vert_list.append([vox_idx, vert1, vert2])
 
         tmp =  np.array(vox_vert_list)
         # Add offset for right hem voxels
@@ -59,6 +59,8 @@ ctm = Extension('cortex.openctm', [
         )
 formats = Extension('cortex.formats', ['cortex/formats.pyx'],
                     include_dirs=get_numpy_include_dirs())
+fmm = Extension('cortex.polyutils.fmm', ['cortex/polyutils/fmm.pyx'],
+                include_dirs=get_numpy_include_dirs())
 
 setup(name='pycortex',
       version='1.1.dev0',
@@ -68,7 +70,7 @@ setup(name='pycortex',
       packages=['cortex', 'cortex.webgl', 'cortex.mapper', 'cortex.dataset',
                 'cortex.blender', 'cortex.tests', 'cortex.quickflat', 'cortex.polyutils',
                 'cortex.export'],
-      ext_modules=cythonize([ctm, formats]),
+      ext_modules=cythonize([ctm, formats, fmm]),
       package_data={
             'cortex': [
                 'svgbase.xml',